@@ -0,0 +1,58 @@
+"""
+Compare the numpy indicator fallbacks of trader.utils.indicators with
+TA-Lib, for speed and for the largest difference of their values after the
+warm-up period (the fallbacks seed their averages differently, so only the
+RSI is expected to converge to the TA-Lib values).
+
+Usage: python scripts/benchmark_indicators.py [SIZE [REPEAT]]
+"""
+from __future__ import print_function
+
+import sys
+import timeit
+
+import numpy as np
+
+from trader.utils import indicators
+
+try:
+    import talib
+except ImportError:
+    talib = None
+
+
+def benchmarks(prices):
+    return [
+        ('sma', lambda: indicators.moving_average(prices, 10),
+         lambda: talib.SMA(prices, 10)),
+        ('rsi', lambda: indicators.relative_strength(prices, 14),
+         lambda: talib.RSI(prices, 14)),
+        ('macd', lambda: indicators.moving_average_convergence(
+            prices, 26, 12, 9)['macd'],
+         lambda: talib.MACD(prices, 12, 26, 9)[0]),
+    ]
+
+
+def main(size=100000, repeat=20):
+    np.random.seed(0)
+    prices = 1.1 + np.cumsum(np.random.randn(size)) * 1e-4
+    warm_up = 500
+
+    print('{} prices, best of {} runs'.format(size, repeat))
+    print('{:<6}{:>14}{:>14}{:>16}'.format(
+        'name', 'numpy (ms)', 'talib (ms)', 'max difference'))
+    for name, fallback, reference in benchmarks(prices):
+        fallback_time = min(timeit.repeat(fallback, number=1, repeat=repeat))
+        if talib is None:
+            print('{:<6}{:>14.3f}{:>14}{:>16}'.format(
+                name, fallback_time * 1000, '-', '-'))
+            continue
+        talib_time = min(timeit.repeat(reference, number=1, repeat=repeat))
+        difference = np.nanmax(np.abs(
+            np.asarray(fallback())[warm_up:] - reference()[warm_up:]))
+        print('{:<6}{:>14.3f}{:>14.3f}{:>16.2e}'.format(
+            name, fallback_time * 1000, talib_time * 1000, difference))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,84 @@
+"""
+Local HTTP server replaying recorded OANDA REST responses, to run the
+oandapy clients (API and AsyncAPI, with api_url='http://localhost:PORT')
+without network access.
+
+The response to a request for an endpoint such as v1/prices is the content
+of RECORDINGS/v1/prices.json, with an ETag (a 304 answering a request
+with the same If-None-Match). The endpoints without a recording get a 404
+in the format of the OANDA errors. DELAY (in seconds, default 0) is added
+to every response to simulate the latency of the API.
+
+Usage: python scripts/stub_oanda_server.py RECORDINGS [PORT [DELAY]]
+"""
+from __future__ import print_function
+
+import hashlib
+import json
+import os
+import sys
+import time
+
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from six.moves.socketserver import ThreadingMixIn
+from six.moves.urllib.parse import urlparse
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, recordings, delay=0):
+        HTTPServer.__init__(self, address, StubHandler)
+        self.recordings = recordings
+        self.delay = delay
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def reply(self):
+        endpoint = urlparse(self.path).path.strip('/')
+        path = os.path.join(self.server.recordings, endpoint + '.json')
+        if '..' not in endpoint.split('/') and os.path.isfile(path):
+            status = 200
+            with open(path, 'rb') as f:
+                body = f.read()
+        else:
+            status = 404
+            body = json.dumps({
+                'code': 404,
+                'message': 'No recording for {}'.format(endpoint),
+            }).encode('utf-8')
+        # Consume the body of POST requests to keep the connection usable
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        time.sleep(self.server.delay)
+        etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+        if status == 200 and self.headers.get('If-None-Match') == etag:
+            status, body = 304, b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if status != 404:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = do_PATCH = do_DELETE = reply
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main(recordings, port=8080, delay=0):
+    server = StubServer(('localhost', int(port)), recordings, float(delay))
+    print('Replaying {} on http://localhost:{}'.format(recordings, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        sys.exit(__doc__.strip())
+    main(*sys.argv[1:4])
@@ -1,5 +1,7 @@
 from coolfig import Settings, Value, types, providers
 
+ENV_PREFIX = 'TRADER_'
+
 
 class TraderSettings(Settings):
     # Account
@@ -9,9 +11,19 @@ class TraderSettings(Settings):
 
     STRATEGY = Value(types.dottedpath)
     CLOCK_INTERVAL = Value(int, default=30)
+    LIVE_STREAMING = Value(types.boolean, default=False)
+    LIVE_QUOTE_MAX_AGE = Value(float, default=5.0)
+    LIVE_ORDER_THREADS = Value(int, default=4)
+    BACKTEST_CLOCK = Value(str, default='candle')
+    BACKTEST_VECTORIZED = Value(types.boolean, default=False)
+    BACKTEST_WORKERS = Value(int, default=1)
+    BACKTEST_SHARD_DAYS = Value(int, default=0)
     BACKTEST_START = Value(str, default='2015.07.15')
     BACKTEST_END = Value(str, default='2015.07.16')
     BACKTEST_STORES_DIR = Value(str, default='tmp/stores')
+    BACKTEST_STORE_BACKEND = Value(str, default='numpy')
+    BACKTEST_DOWNLOAD_THREADS = Value(int, default=8)
+    BACKTEST_SIMULATE_EXITS = Value(types.boolean, default=False)
     GET_INCOMPLETE_CANDLES = True
 
     DEFAULT_INSTRUMENTS = Value(types.list(str), default=[
@@ -43,6 +55,10 @@ class TraderSettings(Settings):
     # Communication
     TELEGRAM_TOKEN = Value(str)
     TELEGRAM_CHAT_ID = Value(str)
+    NOTIFICATION_SINK = Value(str, default='telegram')
+    NOTIFICATION_FILE = Value(str, default='logs/notifications.log')
+    NOTIFICATION_QUEUE_SIZE = Value(int, default=100)
+    NOTIFICATION_BATCH_DELAY = Value(float, default=1.0)
 
     # Strategy specific
     MYSTRATEGY_SMA_FAST = Value(int, default=10)
@@ -59,4 +75,4 @@ class TraderSettings(Settings):
     EM_USE_DOUBLE_CONFIRM = Value(types.boolean, default=True)
 
 
-settings = TraderSettings(providers.EnvConfig(prefix='TRADER_'))
+settings = TraderSettings(providers.EnvConfig(prefix=ENV_PREFIX))
@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+
+import csv
+import itertools
+import logging
+import multiprocessing
+import os
+import random
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import timedelta
+
+from .app_conf import ENV_PREFIX, settings
+from .controller import CandleClock, Controller, SimulatedClock
+from .portfolio import Open, Portfolio
+
+log = logging.getLogger('pyFx')
+
+# Initialised backtest broker, set in the parent process right before the
+# worker pool is created so that the forked workers share its feeds.
+_broker = None
+
+
+def make_clock(clock_type, start, stop, broker, strategies=()):
+    if clock_type == 'candle':
+        log.info('Starting candle-driven simulated clock')
+        ## strategies act every tick timeframe from the start of the clock
+        steps = [broker.timeframe_delta[s.tick_tf] for s in strategies]
+        return CandleClock(start=start, stop=stop, broker=broker,
+                           step=min(steps) if steps else None,
+                           instruments=[s.instrument for s in strategies])
+
+    # Oanda 20:00, Local: 22:00, DailyFx: 16:00
+    clock_interval = settings.CLOCK_INTERVAL
+    log.info('Starting simulated clock with interval {} seconds'.format(
+        clock_interval))
+    return SimulatedClock(start=start, stop=stop, interval=clock_interval)
+
+
+class BacktestJob(object):
+    """
+    A slice of a backtest: the instruments (by name) and the date range to
+    run on a broker whose backtest buffers already cover them, optionally
+    with a set of strategy parameters (see apply_params()). ``bounds`` is
+    the date range of the whole backtest a date range shard is part of.
+    """
+
+    def __init__(self, instruments, start, end, params=None, bounds=None):
+        self.instruments = list(instruments)
+        self.start = start
+        self.end = end
+        self.params = params or OrderedDict()
+        self.bounds = bounds
+
+    def __str__(self):
+        desc = '{} from {} to {}'.format(
+            ','.join(self.instruments), self.start, self.end)
+        if self.params:
+            desc += ' with {}'.format(', '.join(
+                '{}={}'.format(k, v) for k, v in self.params.items()))
+        return desc
+
+
+def apply_params(strategy, params):
+    """
+    Set the given parameters on a strategy instance. Names in the form
+    ``attr.key`` update a single key of a dict attribute (e.g.
+    ``sma_intervals.sma_fast``); upper case names are settings and are
+    handled by override_settings() instead.
+    """
+    for name, value in params.items():
+        if name.isupper():
+            continue
+        attr, _, key = name.partition('.')
+        if key:
+            values = dict(getattr(strategy, attr))
+            values[key] = value
+            value = values
+        setattr(strategy, attr, value)
+
+
+@contextmanager
+def override_settings(params):
+    """
+    Temporarily override the settings (upper case names) in the given
+    parameters, which are read from the environment on each access.
+    """
+    saved = {}
+    for name, value in params.items():
+        if name.isupper():
+            key = ENV_PREFIX + name
+            saved[key] = os.environ.get(key)
+            os.environ[key] = str(value)
+    try:
+        yield
+    finally:
+        for key, value in saved.items():
+            if value is None:
+                del os.environ[key]
+            else:
+                os.environ[key] = value
+
+
+def parameter_grid(space, samples=None, seed=None):
+    """
+    Return all combinations of the given ``{name: [values]}`` search space,
+    or a random subset of ``samples`` combinations of it.
+    """
+    names = list(space.keys())
+    grid = [OrderedDict(zip(names, values))
+            for values in itertools.product(*space.values())]
+    if samples and samples < len(grid):
+        grid = random.Random(seed).sample(grid, samples)
+    return grid
+
+
+def shard_range(start, end, days):
+    """
+    Split the ``[start, end[`` range into consecutive windows of at most the
+    given number of days.
+    """
+    shards = []
+    while start < end:
+        stop = min(start + timedelta(days=days), end)
+        shards.append((start, stop))
+        start = stop
+    return shards
+
+
+def make_jobs(instruments, start, end, shard_days=None):
+    """
+    Create one job per instrument and date range shard. The shards of a
+    backtest only differ in their clock, the candles preceding each shard
+    are part of the shared broker feeds and serve as indicator warm-up.
+    """
+    if shard_days:
+        shards = shard_range(start, end, shard_days)
+    else:
+        shards = [(start, end)]
+    return [BacktestJob([name], shard_start, shard_end,
+                        bounds=(start, end))
+            for shard_start, shard_end in shards
+            for name in sorted(str(inst) for inst in instruments)]
+
+
+class WindDownController(Controller):
+    """
+    Controller running a backtest shard past its end, until the positions
+    still open at the end are closed. The strategies keep their state but
+    don't open new positions, as the following shard takes care of those.
+    """
+
+    def __init__(self, clock, broker, portfolio, strategies, start):
+        super(WindDownController, self).__init__(
+            clock, broker, portfolio, strategies)
+        self.start = start
+
+    def initialize(self, tick):
+        pass
+
+    def execute_tick(self, tick):
+        if tick < self.start:
+            return
+        self._broker.set_current_tick(tick)
+
+        operations = [strategy.tick(tick) for strategy in self._strategies]
+        operations = [[op for op in ops if not isinstance(op, Open)]
+                      for ops in operations if ops]
+        self._portfolio.run_operations(operations, self._strategies)
+
+        if not any(strategy.is_open for strategy in self._strategies):
+            self._stop_requested = True
+
+
+def run_backtest(broker, instruments, start, end, clock_type='candle',
+                 vectorized=False, params=None, write_csv=False,
+                 bounds=None):
+    """
+    Run a backtest in the current process on an initialised backtest broker
+    and return its portfolio. With ``write_csv``, the closed trades are also
+    logged to the portfolio CSV file as the backtest runs.
+
+    A shard of a longer backtest (see ``bounds``) gives the same trades as
+    the unsharded backtest: a shard which isn't the first one acts at its
+    start tick too, and positions still open at the end of a shard are run
+    until they close.
+    """
+    strategies = [settings.STRATEGY(instrument) for instrument in instruments]
+    for strategy in strategies:
+        apply_params(strategy, params or {})
+    if vectorized:
+        ## parameters may change the indicators of the shared feeds
+        if params or broker.indicator_feeds is None:
+            broker.precompute_indicators(strategies)
+        for strategy in strategies:
+            strategy.vectorized = True
+
+    portfolio = Portfolio(broker, mode='backtest', write_csv=write_csv)
+    backtest_start, backtest_end = bounds or (start, end)
+    clock_start = start
+    if start > backtest_start:
+        ## the first tick only initializes the strategies
+        clock_start -= min(broker.timeframe_delta[s.tick_tf]
+                           for s in strategies)
+    clock = make_clock(clock_type, clock_start, end, broker, strategies)
+    controller = Controller(clock, broker, portfolio, strategies)
+    controller.run_until_stopped()
+
+    if end < backtest_end and any(s.is_open for s in strategies):
+        clock = make_clock(
+            clock_type, clock_start, backtest_end, broker, strategies)
+        controller = WindDownController(
+            clock, broker, portfolio, strategies, start=end)
+        controller.run_until_stopped()
+        still_open = [p for s in strategies for p in s.positions]
+        if still_open:
+            log.warning('Discarding {} positions still open at {}'.format(
+                len(still_open), backtest_end))
+    return portfolio
+
+
+def _run_job(args):
+    job, options = args
+    # Instruments are looked up by name, as the pickled instances sent to the
+    # worker are not the ones keying the broker feeds.
+    instruments = [inst for inst in _broker.feeds
+                   if str(inst) in job.instruments]
+    log.info('Running backtest job {}'.format(job))
+    with override_settings(job.params):
+        portfolio = run_backtest(_broker, instruments, job.start, job.end,
+                                 params=job.params, bounds=job.bounds,
+                                 **options)
+    return portfolio.get_trades()
+
+
+def run_jobs(broker, jobs, workers, **options):
+    """
+    Run the given backtest jobs in a pool of forked worker processes, each
+    one working on its own copy-on-write copy of the broker and its feeds.
+    Returns the list of closed trades of each job, in the order of the jobs.
+    """
+    global _broker
+    _broker = broker
+    if options.get('vectorized') and any(not job.params for job in jobs):
+        ## annotate the feeds once, before the workers are forked
+        broker.precompute_indicators(
+            [settings.STRATEGY(instrument) for instrument in broker.feeds])
+    pool = multiprocessing.Pool(processes=workers)
+    try:
+        results = pool.map(_run_job, [(job, options) for job in jobs],
+                           chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+        _broker = None
+    return results
+
+
+def merge_trades(results):
+    """
+    Merge the trades of several backtest jobs into a single list, ordered
+    independently of how the jobs were scheduled.
+    """
+    trades = [trade for trades in results for trade in trades]
+    trades.sort(key=lambda t: (t['close_time'], t['open_time'],
+                               str(t['instrument']), t['side']))
+    return trades
+
+
+def equity_curve(trades):
+    """
+    Return the cumulative profit after each of the given (merged) trades.
+    """
+    equity = 0
+    curve = []
+    for trade in trades:
+        equity += trade['profit_cash'] or 0
+        curve.append(OrderedDict([
+            ('close_time', trade['close_time']),
+            ('instrument', trade['instrument']),
+            ('profit_cash', trade['profit_cash']),
+            ('equity', round(equity, 2)),
+        ]))
+    return curve
+
+
+def summarize(trades):
+    """
+    Return the profit and risk metrics of the given (merged) trades.
+    """
+    curve = equity_curve(trades)
+    peak = drawdown = 0
+    for point in curve:
+        peak = max(peak, point['equity'])
+        drawdown = max(drawdown, peak - point['equity'])
+    wins = sum(1 for trade in trades if (trade['profit_cash'] or 0) > 0)
+    return OrderedDict([
+        ('profit', curve[-1]['equity'] if curve else 0),
+        ('max_drawdown', round(drawdown, 2)),
+        ('trades', len(trades)),
+        ('win_rate', round(100.0 * wins / len(trades), 1) if trades else 0),
+    ])
+
+
+def write_csv(filename, rows):
+    if not rows:
+        return
+    with open(filename, 'wt') as fh:
+        writer = csv.writer(fh)
+        writer.writerow(rows[0].keys())
+        for row in rows:
+            writer.writerow(row.values())
+
+
+def write_report(trades, directory='logs'):
+    """
+    Write the merged trade log and equity curve of a backtest.
+    """
+    timestamp = time.strftime("%Y%m%d-%H%M%S")
+    trades_file = os.path.join(
+        directory, 'backtest_log-{}.csv'.format(timestamp))
+    equity_file = os.path.join(
+        directory, 'backtest_equity-{}.csv'.format(timestamp))
+    write_csv(trades_file, trades)
+    write_csv(equity_file, equity_curve(trades))
+    log.info('Wrote {} trades to {} and {}'.format(
+        len(trades), trades_file, equity_file))
@@ -1,15 +1,55 @@
 import logging
-from dateutil import parser as date_parse
-from time import sleep
+from datetime import datetime
 
-from OpenSSL.SSL import SysCallError
+import numpy as np
 import pandas as pd
-from requests.packages.urllib3.exceptions import ProtocolError
+import pytz
 
-from ..lib.oandapy import OandaError
+from ..lib import rfc3339
 
 log = logging.getLogger('pyFx')
 
+PRICE_COLUMNS = (
+    'closeBid',
+    'closeAsk',
+    'openBid',
+    'openAsk',
+    'highBid',
+    'highAsk',
+    'lowBid',
+    'lowAsk',
+)
+
+
+def parse_times(values):
+    '''
+    Parse RFC 3339 times into a UTC DatetimeIndex. The times sent by the API
+    are handled by the vectorized ISO 8601 parser of pandas, other RFC 3339
+    variants fall back to parsing each time on its own.
+    '''
+    times = pd.to_datetime(values, utc=True)
+    if not isinstance(times, pd.DatetimeIndex):
+        times = pd.DatetimeIndex([
+            rfc3339.parse_datetime(value).astimezone(pytz.utc)
+            for value in values])
+    return times
+
+
+def candles_to_dataframe(candles, columns):
+    '''
+    Build the dataframe of a list of API candles, indexed by time, with
+    float price columns and the mid close price.
+    '''
+    df = pd.DataFrame(data=candles, columns=columns)
+    index = parse_times(df['time'].values)
+    for column in PRICE_COLUMNS:
+        if column in df:
+            df[column] = df[column].values.astype(np.float64)
+    df['time'] = index.to_pydatetime()
+    df['closeMid'] = (df['closeBid'].values + df['closeAsk'].values) / 2
+    df.index = index
+    return df
+
 
 class OandaBrokerBase(object):
     '''
@@ -29,7 +69,6 @@ class OandaBrokerBase(object):
         'lowBid',
         'lowAsk',
     )
-
     def __init__(self, api):
         self._api = api
         self._tick = None
@@ -50,31 +89,25 @@ class OandaBrokerBase(object):
         include_current = kwargs.pop('include_current', False)
         if 'time' not in columns:
             columns = ('time',) + tuple(columns)
-        while True:
-            try:
-                response = self._api.get_history(*args, **kwargs)
-                if response and response.get('candles'):
-                    df = pd.DataFrame(
-                        data=response['candles'],
-                        columns=columns,
-                    )
-                    df['time'] = df['time'].map(date_parse.parse)
-                    df['closeMid'] = df.loc[:,('closeBid','closeAsk')].mean(axis=1)
-                    df.index = df['time']
-                    if not include_current:
-                        df = df[df.complete == True]
-                    return df
-                else:
-                    log.info("no history for {} and timeframe {}".format(
-                             kwargs['instrument']), kwargs['granularity'])
-                    return pd.DataFrame()
-            except ValueError as e:
-                log.warning("[!] Error when loading candles for {}: {}".format(
-                            kwargs['instrument'], e))
-                return pd.DataFrame()
-            except (ProtocolError, OandaError, SysCallError) as e:
-                log.warning("[!] Connection error ({0:s}). Reconnecting...".format(e))
-            sleep(3)
+        for key in ('start', 'end'):
+            if isinstance(kwargs.get(key), datetime):
+                kwargs[key] = kwargs[key].isoformat()
+        # Connection errors are retried by the API, see RequestScheduler
+        try:
+            response = self._api.get_history(*args, **kwargs)
+        except ValueError as e:
+            log.warning("[!] Error when loading candles for {}: {}".format(
+                        kwargs['instrument'], e))
+            return pd.DataFrame()
+        if response and response.get('candles'):
+            df = candles_to_dataframe(response['candles'], columns)
+            if not include_current:
+                df = df[df.complete == True]
+            return df
+        else:
+            log.info("no history for {} and timeframe {}".format(
+                     kwargs['instrument'], kwargs['granularity']))
+            return pd.DataFrame()
 
     def get_price(self, instrument):
         raise NotImplementedError()
@@ -86,6 +119,14 @@ class OandaBrokerBase(object):
     def sync_transactions(self, position):
         raise NotImplementedError()
 
+    def sync_pending(self, positions):
+        '''
+        Return the status of each of the given pending positions ('PENDING',
+        'CONFIRMED' or 'NOTFOUND'), by order id.
+        '''
+        return dict((position.order_id, self.sync_transactions(position))
+                    for position in positions)
+
     def delete_pending_order(self, position):
         raise NotImplementedError()
 
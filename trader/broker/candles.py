@@ -0,0 +1,308 @@
+import re
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+
+from .base import PRICE_COLUMNS
+from .store import to_nanoseconds
+
+GRANULARITY_UNITS = {
+    'S': 'seconds',
+    'M': 'minutes',
+    'H': 'hours',
+    'D': 'days',
+}
+
+
+def granularity_delta(granularity):
+    '''
+    Return the length of the candles of an API granularity such as M5, H4
+    or D.
+    '''
+    match = re.match(r'^([SMHD])(\d*)$', granularity)
+    if not match or (match.group(1) != 'D' and not match.group(2)):
+        raise ValueError('Unsupported granularity {!r}'.format(granularity))
+    unit, count = match.groups()
+    return timedelta(**{GRANULARITY_UNITS[unit]: int(count or 1)})
+
+
+def resample(df, delta, since=None, until=None):
+    '''
+    Aggregate the candles of a history dataframe into candles of length
+    ``delta``, starting at multiples of it since the epoch (UTC): the open
+    of their first candle, the highest high, the lowest low, the close of
+    their last candle and the total volume. The candles starting before
+    ``since`` or ending after ``until`` are not complete.
+    '''
+    if df.empty:
+        return df.copy()
+    length = pd.Timedelta(delta).value
+    times = pd.DatetimeIndex(df.index).asi8
+    buckets = times - times % length
+    starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    ends = np.r_[starts[1:], len(times)] - 1
+
+    index = pd.DatetimeIndex(buckets[starts], tz='UTC')
+    prices = {}
+    for side in ('Bid', 'Ask'):
+        prices['open' + side] = df['open' + side].values[starts]
+        prices['high' + side] = np.maximum.reduceat(
+            df['high' + side].values, starts)
+        prices['low' + side] = np.minimum.reduceat(
+            df['low' + side].values, starts)
+        prices['close' + side] = df['close' + side].values[ends]
+    complete = np.logical_and.reduceat(
+        df['complete'].values.astype(bool), starts)
+    if since is not None:
+        complete &= buckets[starts] >= to_nanoseconds(since)
+    if until is not None:
+        complete &= buckets[starts] + length <= to_nanoseconds(until)
+
+    resampled = pd.DataFrame(prices, index=index, columns=PRICE_COLUMNS)
+    resampled.insert(0, 'time', index.to_pydatetime())
+    resampled.insert(1, 'volume', np.add.reduceat(
+        df['volume'].values.astype(np.int64), starts))
+    resampled.insert(2, 'complete', complete)
+    resampled['closeMid'] = (resampled['closeBid'].values +
+                             resampled['closeAsk'].values) / 2
+    return resampled
+
+
+class CandleBuffer(object):
+    '''
+    Fixed size ring buffer holding the latest candles of an instrument and
+    timeframe in numpy arrays. New candles overwrite the oldest ones in
+    place; the last candle may be incomplete, in which case it is replaced
+    by the next candles written to the buffer.
+    '''
+    price_columns = PRICE_COLUMNS + ('closeMid',)
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.times = np.zeros(capacity, dtype=np.int64)
+        self.volume = np.zeros(capacity, dtype=np.int64)
+        self.complete = np.zeros(capacity, dtype=bool)
+        self.prices = np.zeros((capacity, len(self.price_columns)))
+        self.size = 0
+        ## position of the next candle written
+        self.head = 0
+
+    def __len__(self):
+        return self.size
+
+    def _has_incomplete(self):
+        return self.size and not self.complete[self.head - 1]
+
+    @property
+    def last_complete_time(self):
+        '''
+        Time of the newest complete candle, in nanoseconds since the epoch.
+        '''
+        last = self.head - 1
+        if self._has_incomplete():
+            last -= 1
+        if self.size <= self.head - 1 - last:
+            return None
+        return int(self.times[last])
+
+    def _write(self, times, volume, complete, prices):
+        if self._has_incomplete():
+            self.head = (self.head - 1) % self.capacity
+            self.size -= 1
+        if len(times) > self.capacity:
+            times, volume, complete, prices = [
+                a[-self.capacity:] for a in (times, volume, complete, prices)]
+        positions = (self.head + np.arange(len(times))) % self.capacity
+        self.times[positions] = times
+        self.volume[positions] = volume
+        self.complete[positions] = complete
+        self.prices[positions] = prices
+        self.head = (self.head + len(times)) % self.capacity
+        self.size = min(self.size + len(times), self.capacity)
+
+    def extend(self, df):
+        '''
+        Append the candles of a history dataframe, as returned by
+        ``get_history``.
+        '''
+        if df.empty:
+            return
+        self._write(pd.DatetimeIndex(df.index).asi8,
+                    df['volume'].values,
+                    df['complete'].values.astype(bool),
+                    df.loc[:, self.price_columns].values)
+
+    def append(self, candle):
+        '''
+        Append a candle in the format of the API candles, with the time in
+        nanoseconds since the epoch.
+        '''
+        prices = [candle[c] for c in PRICE_COLUMNS]
+        prices.append((candle['closeBid'] + candle['closeAsk']) / 2)
+        self._write([candle['time']], [candle['volume']],
+                    [candle['complete']], [prices])
+
+    def frame(self, start=None, end=None, include_current=False):
+        '''
+        Return the candles starting after ``start`` and up to ``end`` as a
+        history dataframe.
+        '''
+        order = (self.head - self.size + np.arange(self.size)) % \
+            self.capacity
+        if not include_current and self._has_incomplete():
+            order = order[:-1]
+        times = self.times[order]
+        first, last = 0, len(order)
+        if start is not None:
+            first = times.searchsorted(to_nanoseconds(start), 'right')
+        if end is not None:
+            last = times.searchsorted(to_nanoseconds(end), 'right')
+        order = order[first:last]
+        if not len(order):
+            return pd.DataFrame()
+
+        index = pd.DatetimeIndex(self.times[order], tz='UTC')
+        df = pd.DataFrame(self.prices[order], index=index,
+                          columns=self.price_columns)
+        df.insert(0, 'time', index.to_pydatetime())
+        df.insert(1, 'volume', self.volume[order])
+        df.insert(2, 'complete', self.complete[order])
+        return df
+
+
+class CandleAggregator(object):
+    '''
+    Builds the bid/ask candles of one instrument and timeframe from the
+    prices of a rate stream, in the format of the API candles.
+
+    Candles start at multiples of their length since the epoch (UTC). Ticks
+    older than the current candle are ignored, a candle is complete as soon
+    as a newer tick (of any instrument, see ``advance``) is seen.
+    '''
+
+    def __init__(self, delta, maxlen):
+        self.length = pd.Timedelta(delta).value
+        ## the complete candles and the current one
+        self.candles = CandleBuffer(maxlen + 1)
+        self.current = None
+        self.current_end = None
+
+    def seed(self, df):
+        '''
+        Start from the candles of a history dataframe (as returned by
+        ``get_history``), its last candle becoming the current one if it is
+        not complete yet.
+        '''
+        if df.empty:
+            return
+        self.candles.extend(df)
+        if not df['complete'].values[-1]:
+            columns = ('volume', 'complete') + PRICE_COLUMNS
+            self.current = dict((c, df[c].values[-1]) for c in columns)
+            self.current['time'] = pd.DatetimeIndex(df.index).asi8[-1]
+            self.current_end = self.current['time'] + self.length
+
+    def advance(self, now):
+        '''
+        Complete the current candle if ``now`` (in nanoseconds since the
+        epoch) is past its end.
+        '''
+        if self.current is not None and now >= self.current_end:
+            self.current['complete'] = True
+            self.candles.append(self.current)
+            self.current = None
+
+    def update(self, now, bid, ask):
+        '''
+        Add a price tick at ``now`` (in nanoseconds since the epoch).
+        '''
+        self.advance(now)
+        if self.current is None:
+            start = now - now % self.length
+            last = self.candles.last_complete_time
+            if last is not None and start <= last:
+                # Late tick for a candle which is already complete
+                return
+            self.current = {
+                'time': start,
+                'volume': 0,
+                'complete': False,
+                'openBid': bid, 'openAsk': ask,
+                'highBid': bid, 'highAsk': ask,
+                'lowBid': bid, 'lowAsk': ask,
+            }
+            self.current_end = start + self.length
+        elif now < self.current['time']:
+            return
+        candle = self.current
+        candle['volume'] += 1
+        candle['closeBid'] = bid
+        candle['closeAsk'] = ask
+        if bid > candle['highBid']:
+            candle['highBid'] = bid
+        if ask > candle['highAsk']:
+            candle['highAsk'] = ask
+        if bid < candle['lowBid']:
+            candle['lowBid'] = bid
+        if ask < candle['lowAsk']:
+            candle['lowAsk'] = ask
+
+    def history(self, start=None, end=None, include_current=False):
+        '''
+        Return the candles starting after ``start`` and up to ``end`` as a
+        history dataframe.
+        '''
+        if include_current and self.current is not None:
+            self.candles.append(self.current)
+        return self.candles.frame(start, end, include_current)
+
+
+def current_candles(df, base_delta, delta):
+    '''
+    Return, for each candle of length ``base_delta`` of a history dataframe,
+    the incomplete candle of length ``delta`` it belongs to as of its end:
+    the open of the first candle of the bucket, the highest high and the
+    lowest low so far, its close and the volume so far. The candles which
+    complete their bucket are left out, the complete candle being available
+    at their end instead.
+
+    The incomplete candles are indexed by their start, like the current
+    candle returned by the API; the times of the candles they stand for are
+    returned alongside them.
+    '''
+    length = pd.Timedelta(delta).value
+    times = pd.DatetimeIndex(df.index).asi8
+    keep = (times + pd.Timedelta(base_delta).value) % length != 0
+    buckets = times - times % length
+    new = np.diff(np.r_[-1, buckets]) != 0
+    group = np.cumsum(new) - 1
+    starts = np.flatnonzero(new)
+    position = np.arange(len(times)) - starts[group]
+
+    prices = {}
+    for side in ('Bid', 'Ask'):
+        prices['open' + side] = df['open' + side].values[starts][group]
+        prices['close' + side] = df['close' + side].values
+        high = df['high' + side].values.astype(np.float64)
+        low = df['low' + side].values.astype(np.float64)
+        ## running extremes within each bucket, one position at a time
+        for k in range(1, position.max() + 1 if len(times) else 0):
+            rows = np.flatnonzero(position == k)
+            high[rows] = np.maximum(high[rows], high[rows - 1])
+            low[rows] = np.minimum(low[rows], low[rows - 1])
+        prices['high' + side] = high
+        prices['low' + side] = low
+    volume = np.cumsum(df['volume'].values.astype(np.int64))
+    volume -= (volume - df['volume'].values.astype(np.int64))[starts][group]
+
+    index = pd.DatetimeIndex(buckets[keep], tz='UTC')
+    current = pd.DataFrame(
+        dict((c, v[keep]) for c, v in prices.items()),
+        index=index, columns=PRICE_COLUMNS)
+    current.insert(0, 'time', index.to_pydatetime())
+    current.insert(1, 'volume', volume[keep])
+    current.insert(2, 'complete', np.zeros(len(index), dtype=bool))
+    current['closeMid'] = (current['closeBid'].values +
+                           current['closeAsk'].values) / 2
+    return current, times[keep]
@@ -1,24 +1,78 @@
 import logging
-import os
 from collections import OrderedDict
 from decimal import Decimal, getcontext
-from datetime import timedelta
+from datetime import datetime, timedelta
 from dateutil import parser as date_parse
+from multiprocessing.pool import ThreadPool
 
+import numpy as np
 import pandas as pd
 import pytz
-import warnings
+import six
 
 from .base import OandaBrokerBase
+from .candles import current_candles, granularity_delta, resample
+from .store import get_store
 from ..app_conf import settings
 from ..portfolio import Position
 
 log = logging.getLogger('pyFx')
 
 
+def to_datetime(value):
+    '''Accept both datetimes and ISO 8601 strings.'''
+    if isinstance(value, six.string_types):
+        return date_parse.parse(value)
+    return value
+
+
+class FeedCursor(object):
+    '''
+    Integer-position access to a feed sorted by time. The window bounds are
+    remembered between lookups and only moved forward as the simulated clock
+    advances, which turns a lookup into a constant-time search in a few
+    neighbouring candles; big jumps (or going back in time) fall back to a
+    binary search over the whole feed. The feed is looked up by its index,
+    or by the given ``times`` (in nanoseconds since the epoch).
+    '''
+    lookahead = 16
+
+    def __init__(self, df, times=None):
+        self.df = df
+        if times is None:
+            times = pd.DatetimeIndex(df.index).asi8
+        self.times = times
+        self._start = 0
+        self._end = 0
+
+    def _seek(self, pos, value, side):
+        times = self.times
+        base = max(pos - 1, 0)
+        near = times[base:base + self.lookahead]
+        offset = near.searchsorted(value, side=side)
+        if (offset > 0 or base == 0) and \
+                (offset < len(near) or base + len(near) == len(times)):
+            return base + int(offset)
+        return int(times.searchsorted(value, side=side))
+
+    def window(self, start, end):
+        '''
+        Return a view on the candles with ``start <= time <= end``; a
+        ``start`` of None returns everything up to ``end``.
+        '''
+        first = 0
+        if start is not None:
+            first = self._start = self._seek(
+                self._start, pd.Timestamp(start).value, 'left')
+        self._end = self._seek(self._end, pd.Timestamp(end).value, 'right')
+        return self.df.iloc[first:self._end]
+
+
 class OandaBacktestBroker(OandaBrokerBase):
     pip_to_cash = 1000.00 * 50 ## conversion from pip to cash(?)
     time_delta = timedelta(seconds=1)
+    ## timeframes whose current candle is built from the M5 candles
+    current_timeframes = ('H1', 'H2')
     timeframe_delta = {
         'H2': timedelta(minutes=120),
         'H1': timedelta(minutes=60),
@@ -31,14 +85,36 @@ class OandaBacktestBroker(OandaBrokerBase):
         self._current_balance = self._initial_balance = initial_balance
         self._transaction_id = 0
         self._account_id = account_id
+        ## set by precompute_indicators()
+        self.indicator_feeds = None
+        ## index of the first M5 candle not checked by check_exits() yet,
+        ## by order id
+        self._exit_checked = {}
 
     def _get_id(self):
         self._transaction_id += 1
         return self._transaction_id
 
     def get_price(self, instrument):
-        # TODO Return via tick
-        return None
+        '''
+        Return the close prices of the last M5 candle complete at the current
+        tick, in the format of the API prices.
+        '''
+        cursor = self._cursors.get((instrument, 'M5'))
+        if cursor is None or self._tick is None:
+            return None
+        end = cursor.times.searchsorted(
+            pd.Timestamp(self._tick - self.timeframe_delta['M5']).value,
+            side='right')
+        if not end:
+            return None
+        candle = cursor.df.iloc[end - 1]
+        return {
+            'instrument': str(instrument),
+            'time': candle['time'],
+            'bid': float(candle['closeBid']),
+            'ask': float(candle['closeAsk']),
+        }
 
     def get_account_balance(self):
         return self._current_balance
@@ -53,10 +129,88 @@ class OandaBacktestBroker(OandaBrokerBase):
             open_time=self._tick,
             order_id=self._get_id(),
             order_type=order_type,
+            stop_loss=stop_loss,
+            take_profit=take_profit,
         )
         pos.transaction_id = pos.order_id
         return pos
 
+    def check_exits(self, positions):
+        '''
+        Find the open positions whose stop loss or take profit was reached by
+        the M5 candles completed since they were opened (or last checked),
+        and return them with the price and the time (the end of the first
+        candle crossing the level) at which they were closed. A level is
+        filled at the open of the candle if the candle opens beyond it; a
+        candle crossing both levels reaches the stop loss first.
+        '''
+        M5_length = pd.Timedelta(self.timeframe_delta['M5']).value
+        tick = pd.Timestamp(self._tick).value
+        groups = OrderedDict()
+        for pos in positions:
+            if pos.stop_loss is not None or pos.take_profit is not None:
+                groups.setdefault(pos.instrument, []).append(pos)
+
+        exits = []
+        for instrument, group in groups.items():
+            cursor = self._cursors[(instrument, 'M5')]
+            stop = cursor.times.searchsorted(tick - M5_length, side='right')
+            starts = np.array([
+                self._exit_checked[pos.order_id]
+                if pos.order_id in self._exit_checked
+                else cursor.times.searchsorted(
+                    pd.Timestamp(pos.open_time).value)
+                for pos in group])
+            first = starts.min()
+            for pos in group:
+                self._exit_checked[pos.order_id] = stop
+            if first >= stop:
+                continue
+
+            ## bars x positions, the bars before a position don't count
+            rows = np.arange(first, stop)[:, None]
+            active = rows >= starts[None, :]
+            side = np.array([pos.side == 'buy' for pos in group])
+            stop_loss = np.array([np.nan if pos.stop_loss is None
+                                  else float(pos.stop_loss) for pos in group])
+            take_profit = np.array([
+                np.nan if pos.take_profit is None
+                else float(pos.take_profit) for pos in group])
+            df = cursor.df
+            window = slice(first, stop)
+            ## buy positions are closed at the bid, sell ones at the ask
+            opens = np.where(side, df['openBid'].values[window, None],
+                             df['openAsk'].values[window, None])
+            highs = np.where(side, df['highBid'].values[window, None],
+                             df['highAsk'].values[window, None])
+            lows = np.where(side, df['lowBid'].values[window, None],
+                            df['lowAsk'].values[window, None])
+            with np.errstate(invalid='ignore'):
+                stop_hits = active & np.where(
+                    side, lows <= stop_loss, highs >= stop_loss)
+                profit_hits = active & np.where(
+                    side, highs >= take_profit, lows <= take_profit)
+            hits = stop_hits | profit_hits
+            crossed = hits.any(axis=0)
+            bars = hits.argmax(axis=0)
+
+            for i in np.flatnonzero(crossed):
+                bar = bars[i]
+                pos = group[i]
+                if stop_hits[bar, i]:
+                    level, lower = stop_loss[i], side[i]
+                else:
+                    level, lower = take_profit[i], not side[i]
+                ## gaps beyond the level are filled at the open
+                price = opens[bar, i]
+                price = min(level, price) if lower else max(level, price)
+                exits.append((
+                    pos, Decimal(str(price)),
+                    (df.index[first + bar] + self.timeframe_delta['M5']
+                     ).to_pydatetime()))
+                del self._exit_checked[pos.order_id]
+        return exits
+
     def close_trade(self, position):
         '''Close a position'''
         price = position.close_price
@@ -81,158 +235,258 @@ class OandaBacktestBroker(OandaBrokerBase):
         '''Interface'''
         return True
 
-    def M5_injection(self, df, tf, tf_dict):
-        '''Inject M5 candles within the H1 and H2 dataframes.'''
-        df.loc[:,'tf'] = tf
-        M5_candles = tf_dict['M5']
-        M5_candles.loc[:,'tf'] = 'M5'
-        M5_candles.complete = False
-
-        # drop redundant candles
-        # edge case for ticks between XX:00:00 - XX:04:59
-        if tf == 'H1':
-            start, rate = 0, 1
-        elif tf == 'H2':
-            start, rate = 1, 2
-        else:
-            start, rate = 24, 24
-        for i in xrange(start, 24, rate):
-            init_time = '{}:55'.format(i)
-            final_time = '{}:59'.format(i)
-            to_drop = M5_candles.between_time(init_time,final_time).index
-            M5_candles = M5_candles.drop(to_drop)
-
-        df = pd.concat([df, M5_candles])
-        df = df.sort_index(kind='mergesort')
-
-        return df
+    def fetch_history(self, instrument, granularity, start, end):
+        '''
+        Download the complete candles with start < time <= end from the API,
+        in pages of 2000 candles.
+        '''
+        pages = []
+        next_start = start.isoformat()
+
+        while next_start != None:
+            data_buffer = super(OandaBacktestBroker, self).get_history(
+                instrument=instrument,
+                granularity=granularity,
+                candleFormat='bidask',
+                start=next_start,
+                includeFirst='false',
+                count=2000,
+            )
+            if data_buffer.empty:
+                break
+            last_tick = data_buffer.index[-1]
+            if last_tick > end:
+                ## achieve same result as (df.time <= end)
+                data_buffer = data_buffer[:end]
+                next_start = None
+            else:
+                next_start = last_tick.isoformat()
+
+            pages.append(data_buffer)
+
+        if not pages:
+            return pd.DataFrame(
+                columns=self.default_history_dataframe_columns)
+        return pd.concat(pages)
 
     def init_backtest(self, start, end, strategies):
         '''
         First method to be ran which loads all the strategies and timeframes
-        into memory. It either loads the info from HDF stores in disk or queries
-        the API.
+        into memory. Only the candles of the finest timeframe are loaded, the
+        other timeframes are resampled from them. Candles are read from the
+        local candle store, only the ranges it doesn't cover yet are queried
+        from the API, concurrently for all the instruments.
         '''
         # Silence pandas errors
         pd.options.mode.chained_assignment = None
-        warnings.filterwarnings('ignore', \
-            category=pd.io.pytables.PerformanceWarning)
 
         self.feeds = OrderedDict()
+        ## the current H1/H2 candles at the end of each M5 candle, and the
+        ## times of these M5 candles
+        self.current_feeds = OrderedDict()
         log.info('Initialising backtest buffer...')
-        stores_dir = settings.BACKTEST_STORES_DIR
-        if not os.path.exists(stores_dir):
-            os.makedirs(stores_dir)
+        store = get_store(settings.BACKTEST_STORE_BACKEND,
+                          settings.BACKTEST_STORES_DIR)
+        now = datetime.utcnow().replace(tzinfo=pytz.utc)
+
+        # TODO Make sure first candle gets loaded without hack
+        ## load earlier data so initial backtesting buffer
+        ## is not completely empty
+        history_start = start - timedelta(days=2)
+
+        ## finest timeframe first, so that M5 candles are processed first
+        timeframes = sorted(
+            set(tf for strategy in strategies for tf in strategy.timeframes),
+            key=granularity_delta)
+        self.timeframe_delta = dict(self.timeframe_delta, **dict(
+            (tf, granularity_delta(tf)) for tf in timeframes))
+        base = timeframes[0]
+        ## instruments are keyed by name, as they share the store files
+        instruments = OrderedDict(
+            (str(strategy.instrument), strategy.instrument)
+            for strategy in strategies)
+
+        def load(instrument):
+            return store.load(
+                instrument, base, history_start, end, self.fetch_history,
+                complete_until=now - self.timeframe_delta[base])
+
+        pool = ThreadPool(processes=max(1, min(
+            settings.BACKTEST_DOWNLOAD_THREADS, len(instruments))))
+        try:
+            frames = dict(zip(instruments, pool.map(
+                load, instruments.values())))
+        finally:
+            pool.close()
+            pool.join()
+
         for strategy in strategies:
             instrument = strategy.instrument
-
-            store_fname = (
-                '{}/history-{}-{}-{}-{}.h5'
-                .format(
-                    stores_dir,
-                    strategy.__class__.__name__,
-                    instrument,
-                    start.strftime('%s'),
-                    end.strftime('%s'),
-                )
-            )
-            store = pd.HDFStore(store_fname, mode='a')
-            timeframes = strategy.timeframes
             tf_dict = OrderedDict()
-
-            ## ensure M5 candles are processed first
-            tf_order = ['M5', 'M15', 'H1', 'H2']
-            timeframes = [tf for tf in tf_order if tf in timeframes]
-
-            ## fetch the timeframe from disk if it was already
-            ## downloaded otherwise download it through the API
-            for tf in timeframes:
-                if tf in store:
-                    source = 'HDFStore'
-                    df = store[tf]
-                    log.debug('loading data from HDFstore {}/{}'.format(
-                              store.filename, tf))
+            base_df = frames[str(instrument)]
+            if base_df is None:
+                base_df = pd.DataFrame(
+                    columns=self.default_history_dataframe_columns)
+
+            for tf in [tf for tf in timeframes if tf in strategy.timeframes]:
+                if tf == base:
+                    df = base_df
                 else:
-                    source = 'API'
-                    df = pd.DataFrame(
-                         columns=self.default_history_dataframe_columns)
-
-                    # TODO Make sure first candle gets loaded without hack
-
-                    ## load earlier data so initial backtesting buffer
-                    ## is not completely empty
-                    next_start = (start - timedelta(days=2)).isoformat()
-
-                    while next_start != None:
-
-                        data_buffer = super(OandaBacktestBroker, self).get_history(
-                            instrument=instrument,
-                            granularity=tf,
-                            candleFormat='bidask',
-                            start=next_start,
-                            includeFirst='false',
-                            count=2000,
-                        )
-                        if data_buffer.empty:
-                            break
-                        last_tick = data_buffer.tail(1).time.values[0].replace(
-                            tzinfo=pytz.utc)
-                        if last_tick > end:
-                            ## achieve same result as (df.time <= end)
-                            data_buffer = data_buffer[:end]
-                            next_start = None
-                        else:
-                            next_start = last_tick.isoformat()
-
-                        df = pd.concat([df, data_buffer])
-
-                    ## inject current_candles
-                    if tf in {'H1', 'H2'}:
-                        df = self.M5_injection(df, tf, tf_dict)
-
-                    log.debug('saving data to HDFstore {}/{}'.format(
-                        store.filename, tf))
-                    ## save df to disk
-                    df.to_hdf(store, tf)
+                    df = resample(base_df, self.timeframe_delta[tf],
+                                  since=history_start, until=min(end, now))
+                    df = df[df['complete'].values]
 
                 ## store df in memory
                 tf_dict[tf] = df
 
-                log.info("loaded {} candles for {}/{} (from {})".format(
-                    df.shape[0], strategy.instrument, tf, source))
+                log.info("loaded {} candles for {}/{}".format(
+                    df.shape[0], strategy.instrument, tf))
 
-            store.close()
             self.feeds[instrument] = tf_dict
+            self.current_feeds[instrument] = OrderedDict(
+                (tf, current_candles(tf_dict['M5'],
+                                     self.timeframe_delta['M5'],
+                                     self.timeframe_delta[tf]))
+                for tf in tf_dict if tf in self.current_timeframes)
 
+        self._index_feeds()
         return True
 
-    def get_history(self, *args, **kwargs):
+    def _index_feeds(self):
+        '''
+        Set up a cursor over each loaded feed and over the current candles of
+        the H1/H2 feeds, looked up by the time of their M5 candle.
+        '''
+        self._cursors = {}
+        self._current_cursors = {}
+        for instrument, tf_dict in self.feeds.items():
+            for tf, df in tf_dict.items():
+                self._cursors[(instrument, tf)] = FeedCursor(df)
+            for tf, (df, times) in self.current_feeds[instrument].items():
+                self._current_cursors[(instrument, tf)] = FeedCursor(
+                    df, times)
+
+    def precompute_indicators(self, strategies):
+        '''
+        Annotate the complete feed of every strategy timeframe once, so that
+        vectorized strategies read their indicators by index instead of
+        re-annotating a window of candles on every tick. The current H1/H2
+        candles are annotated too, see _annotate_current().
+        '''
+        self.indicator_feeds = OrderedDict()
+        self._indicator_cursors = {}
+        self._indicator_current_cursors = {}
+        for strategy in strategies:
+            instrument = strategy.instrument
+            tf_dict = OrderedDict()
+            for tf in self.feeds[instrument]:
+                df = self._cursors[(instrument, tf)].df
+                tf_dict[tf] = strategy.annotate_data(df.copy(), tf)
+                self._indicator_cursors[(instrument, tf)] = FeedCursor(
+                    tf_dict[tf])
+                current = self._current_cursors.get((instrument, tf))
+                if current is not None:
+                    self._indicator_current_cursors[(instrument, tf)] = \
+                        FeedCursor(self._annotate_current(
+                            strategy, df, current, tf), current.times)
+                log.debug('precomputed indicators for {}/{}'.format(
+                    instrument, tf))
+            self.indicator_feeds[instrument] = tf_dict
+
+    def _annotate_current(self, strategy, df, current, tf):
+        '''
+        Annotate each current candle of the ``current`` cursor as the last
+        candle of the window get_history() returns with it, i.e. at the tick
+        its M5 candle completes: the complete candles of the last
+        ``buffer_size`` timeframes (or all of them) followed by the current
+        candle.
+        '''
+        if current.df.empty:
+            return current.df
+        times = pd.DatetimeIndex(df.index).asi8
+        ticks = current.times + int(
+            self.timeframe_delta['M5'].total_seconds()) * 10**9
+        tf_ns = int(self.timeframe_delta[tf].total_seconds()) * 10**9
+        stops = times.searchsorted(ticks - tf_ns, side='right')
+        buffer_size = getattr(strategy, 'buffer_size', None)
+        if buffer_size is None:
+            starts = np.zeros_like(stops)
+        else:
+            starts = times.searchsorted(
+                ticks - (buffer_size + 1) * tf_ns, side='right')
+
+        rows = []
+        for i, (first, last) in enumerate(zip(starts, stops)):
+            window = pd.concat(
+                [df.iloc[first:last], current.df.iloc[i:i + 1]])
+            rows.append(strategy.annotate_data(window, tf).iloc[-1:])
+        return pd.concat(rows)
+
+    def get_indicator_history(self, instrument, granularity, end,
+                              include_current=False):
+        '''
+        Return the annotated candles of the given timeframe which are
+        complete at ``end``, as a view on the precomputed feed. With
+        ``include_current``, the annotated current H1/H2 candle is appended,
+        if any.
+        '''
+        cursor = self._indicator_cursors[(instrument, granularity)]
+        df = cursor.window(None, end - self.timeframe_delta.get(granularity))
 
-        instrument = kwargs.get('instrument')
-        timeframe = kwargs.get('granularity')
-        start = kwargs.get('start')
-        end = kwargs.get('end')
-        include_current = kwargs.get('include_current', False)
+        current = self._indicator_current_cursors.get(
+            (instrument, granularity))
+        if include_current and current is not None:
+            M5_end = end - self.timeframe_delta.get('M5')
+            M5_start = M5_end - self.timeframe_delta.get('M5')
+            current = current.window(M5_start + self.time_delta, M5_end)
+            if not current.empty:
+                df = pd.concat([df, current])
 
-        df = self.feeds[instrument][timeframe]
-        start = date_parse.parse(start)
-        end = date_parse.parse(end)
+        return df
+
+    def get_candle_ticks(self, start, stop, instruments=None):
+        '''
+        Return the sorted moments within ]start, stop[ at which at least one
+        of the loaded feeds (of the given instruments, or all of them) has a
+        new candle available, i.e. the candle time plus the duration of its
+        timeframe.
+        '''
+        ticks = []
+        for (instrument, tf), cursor in self._cursors.items():
+            if instruments is not None and instrument not in instruments:
+                continue
+            delta = int(self.timeframe_delta[tf].total_seconds()) * 10**9
+            ticks.append(cursor.times + delta)
+        if not ticks:
+            return []
+
+        ticks = pd.DatetimeIndex(np.unique(np.concatenate(ticks)), tz='UTC')
+        ticks = ticks[(ticks > start) & (ticks < stop)]
+        return ticks.to_pydatetime()
+
+    def get_history(self, instrument, granularity, start, end,
+                    include_current=False, **kwargs):
+        '''
+        Return the candles of the given timeframe newer than ``start`` and
+        complete at ``end`` (datetimes or ISO 8601 strings). With
+        ``include_current``, the current H1/H2 candle (as of the last
+        complete M5 candle) is appended, if any.
+        '''
+        start = to_datetime(start)
+        end = to_datetime(end)
 
-        start_main = start + self.time_delta
-        end_main = end - self.timeframe_delta.get(timeframe)
+        ## achieve same result as (df.time > start) & (df.time <= end_main)
+        df = self._cursors[(instrument, granularity)].window(
+            start + self.time_delta,
+            end - self.timeframe_delta.get(granularity))
 
-        if timeframe in {'H1', 'H2'} and include_current:
-            ## achieve same result as (df.time > start) & (df.time < end)
-            M5_start = end - self.timeframe_delta.get('M5') * 2
+        current = self._current_cursors.get((instrument, granularity))
+        if include_current and current is not None:
+            ## same as (df.time > M5_start) & (df.time <= M5_end)
             M5_end = end - self.timeframe_delta.get('M5')
-
-            df = df[start_main:M5_end]
-            df = df.loc[(df.index <= end_main) & (df.tf == timeframe) | \
-                (df.index > M5_start) & (df.tf == 'M5')]
-        else:
-            ## achieve same result as (df.time > start) & (df.time <= end_main)
-            df = df[start_main:end_main]
-            if timeframe in {'H1', 'H2'}:
-                df = df.loc[(df.tf == timeframe)]
+            M5_start = max(start, M5_end - self.timeframe_delta.get('M5'))
+            current = current.window(M5_start + self.time_delta, M5_end)
+            if not current.empty:
+                df = pd.concat([df, current])
 
         return df
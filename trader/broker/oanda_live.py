@@ -1,12 +1,13 @@
 from decimal import Decimal
 from datetime import timedelta
-from time import sleep
+from time import time
 from math import log10
 import logging
 
-from requests.packages.urllib3.exceptions import ProtocolError
-
 from .base import OandaBrokerBase
+from .candles import CandleBuffer
+from .store import to_datetime
+from ..app_conf import settings
 from ..lib.oandapy import OandaError
 from ..portfolio import Position
 
@@ -15,10 +16,63 @@ log = logging.getLogger('pyFx')
 
 
 class OandaRealtimeBroker(OandaBrokerBase):
+    timeframe_delta = {
+        'H2': timedelta(minutes=120),
+        'H1': timedelta(minutes=60),
+        'M15': timedelta(minutes=15),
+        'M5': timedelta(minutes=5),
+    }
+    ## minimum number of candles kept for each instrument and timeframe
+    buffer_size = 500
+
     def __init__(self, api, account_id):
         super(OandaRealtimeBroker, self).__init__(api)
         self._account_id = account_id
         self.last_transaction_id = None
+        ## fill transactions by order id, see sync_pending()
+        self.fills = {}
+        self.buffers = {}
+        ## instruments quoted together by refresh_quotes()
+        self.instruments = set()
+        ## latest quote of each instrument and when it was received
+        self.quotes = {}
+        self.quote_times = {}
+
+    def get_history(self, *args, **kwargs):
+        '''
+        Return the candles between ``start`` and ``end`` from a buffer of the
+        latest candles of the instrument and timeframe, which only requests
+        the candles newer than its last complete one from the API. Other
+        queries (by count, with custom columns, ...) go to the API.
+        '''
+        instrument = str(kwargs.get('instrument'))
+        self.instruments.add(instrument)
+        granularity = kwargs.get('granularity')
+        start, end = kwargs.get('start'), kwargs.get('end')
+        if args or start is None or end is None or 'columns' in kwargs or \
+                granularity not in self.timeframe_delta:
+            return super(OandaRealtimeBroker, self).get_history(
+                *args, **kwargs)
+
+        buffer = self.buffers.get((instrument, granularity))
+        last = buffer.last_complete_time if buffer else None
+        if last is None:
+            capacity = int((end - start).total_seconds() //
+                           self.timeframe_delta[granularity].total_seconds())
+            buffer = self.buffers[instrument, granularity] = CandleBuffer(
+                max(capacity + 2, self.buffer_size))
+            params = {'start': start,
+                      'includeFirst': kwargs.get('includeFirst')}
+        else:
+            params = {'start': to_datetime(last), 'includeFirst': 'false'}
+        params = dict((k, v) for k, v in params.items() if v is not None)
+        buffer.extend(super(OandaRealtimeBroker, self).get_history(
+            instrument=instrument,
+            granularity=granularity,
+            end=end,
+            include_current=True,
+            **params))
+        return buffer.frame(start, end, kwargs.get('include_current', False))
 
     def get_account_balance(self):
         ret = self._api.get_account(self._account_id)
@@ -26,14 +80,34 @@ class OandaRealtimeBroker(OandaBrokerBase):
             return ret['balance']
         return False
 
-    def get_price(self, instrument):
+    def set_quote(self, quote, received=None):
+        self.quotes[quote['instrument']] = quote
+        self.quote_times[quote['instrument']] = received or time()
+
+    def refresh_quotes(self):
+        '''
+        Quote all the active instruments with a single request.
+        '''
         params = {
-            'instruments': str(instrument),
+            'instruments': ','.join(sorted(self.instruments)),
         }
         ret = self._api.get_prices(**params)
-        if ret and 'prices' in ret and len(ret['prices']) > 0:
-            return ret['prices'][0]
-        return None
+        received = time()
+        for quote in (ret or {}).get('prices', []):
+            self.set_quote(quote, received)
+
+    def get_price(self, instrument):
+        '''
+        Return the latest quote of the instrument, requesting the quotes of
+        all the active instruments if it is older than LIVE_QUOTE_MAX_AGE
+        seconds.
+        '''
+        name = str(instrument)
+        self.instruments.add(name)
+        if time() - self.quote_times.get(name, 0) > \
+                settings.LIVE_QUOTE_MAX_AGE:
+            self.refresh_quotes()
+        return self.quotes.get(name)
 
     def open_order(self, instrument, units, side, order_type,
                    price=None, expiry=None, stop_loss=None, take_profit=None):
@@ -76,14 +150,13 @@ class OandaRealtimeBroker(OandaBrokerBase):
         #        params['stopLoss'] = stop_loss_price
 
         #print params
+        # Refused requests are retried by the API, see RequestScheduler
         ret = None
-        for _ in range(3):
-            try:
-                ret = self._api.create_order(self._account_id, **params)
-                if ret:
-                    break
-            except OandaError as e:
-                print "[!] Error while creating {} oder: {}. Retrying...".format(instrument, e)
+        try:
+            ret = self._api.create_order(self._account_id, **params)
+        except OandaError as e:
+            log.warning("[!] Error while creating {} order: {}".format(
+                instrument, e))
 
         if not ret:
             return None
@@ -105,31 +178,22 @@ class OandaRealtimeBroker(OandaBrokerBase):
         return None
 
     def close_trade(self, position):
-        # This method will block the rest, but it's important
-        # that trades get closed immediately
-        # while True:
-        for _ in range(3):
-            try:
-                ret = self._api.close_trade(
-                    self._account_id,
-                    position.transaction_id
-                )
-                if all(k in ret for k in ('id', 'price', 'time', 'profit')):
-                    position.close_price = ret['price']
-                    position.profit_cash = ret['profit']
-                    position.close_time = ret['time']
-                    return position
-                # TODO Check transactions
-                else:
-                    pass
-            # TODO What if transaction was closed by broker?
-            # TODO Handle Oanda exceptions properly
-            except (ProtocolError, OandaError) as e:
-                print "[!] Error during CLOSE action ({}). Trying again...".format(
-                    e)
-                sleep(3)
+        # Refused requests are retried by the API, see RequestScheduler
+        try:
+            ret = self._api.close_trade(
+                self._account_id,
+                position.transaction_id
+            )
+            if all(k in ret for k in ('id', 'price', 'time', 'profit')):
+                position.close_price = ret['price']
+                position.profit_cash = ret['profit']
+                position.close_time = ret['time']
+                return position
+            # TODO Check transactions
+        # TODO What if transaction was closed by broker?
+        except OandaError as e:
+            log.warning("[!] Error during CLOSE action ({})".format(e))
         return position
-        return False
 
     def delete_pending_order(self, position):
         try:
@@ -197,3 +261,79 @@ class OandaRealtimeBroker(OandaBrokerBase):
                                 return "CONFIRMED"
         # 3. Lastly, if ID isn't showing up anymore, return the info
         return "NOTFOUND"
+
+    ## transaction types filling an order (other than a market order)
+    fill_types = ('ORDER_FILLED', 'STOP_LOSS_FILLED', 'TAKE_PROFIT_FILLED',
+                  'TRAILING_STOP_FILLED')
+    ## maximum number of items per listing request
+    page_size = 500
+
+    def _update_fills(self):
+        '''
+        Download the transactions since the last one seen (the latest page
+        of them on the first call) and index the fills by the id of the
+        order they filled.
+        '''
+        params = {'count': self.page_size}
+        if self.last_transaction_id is not None:
+            params['minId'] = self.last_transaction_id + 1
+        newest = self.last_transaction_id
+        while True:
+            ret = self._api.get_transaction_history(
+                account_id=self._account_id, **params)
+            transactions = (ret or {}).get('transactions', [])
+            for trans in transactions:
+                if trans.get('type') == 'MARKET_ORDER_CREATE':
+                    self.fills[trans['id']] = trans
+                elif trans.get('type') in self.fill_types and \
+                        trans.get('orderId'):
+                    self.fills[trans['orderId']] = trans
+            ids = [trans['id'] for trans in transactions]
+            if ids:
+                newest = max(ids + [newest or 0])
+            # Pages go from the newest transactions backwards
+            if len(ids) < self.page_size or 'minId' not in params:
+                break
+            params['maxId'] = min(ids) - 1
+        self.last_transaction_id = newest
+
+    def sync_pending(self, positions):
+        '''
+        Sync all the pending positions with one listing of the open orders,
+        one of the open trades and one request for the new transactions,
+        instead of sync_transactions() for each of them.
+        '''
+        if not positions:
+            return {}
+        try:
+            orders = self._api.get_orders(
+                self._account_id, count=self.page_size).get('orders', [])
+            trades = self._api.get_trades(
+                self._account_id, count=self.page_size).get('trades', [])
+            self._update_fills()
+        except OandaError as e:
+            log.warning("[!] Error when syncing the pending orders: "
+                        "{}".format(e))
+            return dict((position.order_id, 'PENDING')
+                        for position in positions)
+        order_ids = set(order['id'] for order in orders)
+        trade_ids = set(trade['id'] for trade in trades)
+
+        statuses = {}
+        for position in positions:
+            if position.order_type in ['limit', 'market', 'marketIfTouched'] \
+                    and position.order_id in order_ids or \
+                    position.order_type in ['stop', 'takeprofit'] and \
+                    position.order_id in trade_ids:
+                statuses[position.order_id] = 'PENDING'
+                continue
+            trans = self.fills.get(position.order_id)
+            if trans is None or (position.order_type != 'market' and
+                                 trans['type'] == 'MARKET_ORDER_CREATE'):
+                statuses[position.order_id] = 'NOTFOUND'
+                continue
+            position.open_price = trans.get('price')
+            position.transaction_id = trans.get('id')
+            position.stop_loss = trans.get('stopLossPrice')
+            statuses[position.order_id] = 'CONFIRMED'
+        return statuses
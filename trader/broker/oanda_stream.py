@@ -0,0 +1,133 @@
+import logging
+import threading
+from time import sleep, time
+
+import numpy as np
+from six.moves import queue
+
+from .base import parse_times
+from .candles import CandleAggregator
+from .oanda_live import OandaRealtimeBroker
+from ..lib.oandapy import Streamer
+
+
+log = logging.getLogger('pyFx')
+
+
+class PriceStreamer(Streamer):
+    '''
+    Rate streamer pushing the received price ticks to its ``prices`` queue,
+    reconnecting when the stream fails.
+    '''
+    ## delay before reconnecting a failed stream, doubled on every attempt
+    retry_delay = 1
+    max_retry_delay = 60
+
+    def __init__(self, *args, **kwargs):
+        super(PriceStreamer, self).__init__(*args, **kwargs)
+        self.prices = queue.Queue()
+        self.delay = self.retry_delay
+
+    def on_success(self, data):
+        self.delay = self.retry_delay
+        if 'tick' in data:
+            self.prices.put(data['tick'])
+
+    def on_error(self, data):
+        raise IOError(data)
+
+    def run(self, **params):
+        self.connected = True
+        while self.connected:
+            try:
+                self.start(**params)
+            except Exception as e:
+                log.warning("[!] Price stream error ({}). Reconnecting "
+                            "in {}s...".format(e, self.delay))
+                sleep(self.delay)
+                self.delay = min(self.delay * 2, self.max_retry_delay)
+
+
+class OandaStreamingBroker(OandaRealtimeBroker):
+    '''
+    Live broker building the candles of the traded instruments from a rate
+    stream instead of polling them from the REST API. The candles are seeded
+    from the API when the stream is started, after which ``get_history`` is
+    served locally, and ``get_price`` from the streamed quotes as long as
+    they are fresh.
+    '''
+    def __init__(self, api, streamer, account_id):
+        super(OandaStreamingBroker, self).__init__(api, account_id)
+        self.streamer = streamer
+        self.aggregators = {}
+        self.last_time = None
+
+    def start_streaming(self, strategies):
+        for strategy in strategies:
+            name = str(strategy.instrument)
+            self.instruments.add(name)
+            aggregators = self.aggregators.setdefault(name, {})
+            count = getattr(strategy, 'buffer_size', self.buffer_size) + 1
+            for tf in strategy.timeframes:
+                if tf in aggregators:
+                    continue
+                aggregators[tf] = CandleAggregator(
+                    self.timeframe_delta[tf], maxlen=count)
+                aggregators[tf].seed(
+                    super(OandaStreamingBroker, self).get_history(
+                        instrument=name,
+                        granularity=tf,
+                        count=count,
+                        include_current=True,
+                    ))
+
+        thread = threading.Thread(
+            target=self.streamer.run,
+            kwargs={'accountId': self._account_id,
+                    'instruments': ','.join(sorted(self.aggregators))})
+        thread.daemon = True
+        thread.start()
+
+    def stop_streaming(self):
+        self.streamer.disconnect()
+
+    def wait_for_prices(self, timeout=None):
+        '''
+        Apply the price ticks received since the last call, waiting up to
+        ``timeout`` seconds for the first one. Return the time of the newest
+        tick, or None if none was received.
+        '''
+        try:
+            ticks = [self.streamer.prices.get(timeout=timeout)]
+        except queue.Empty:
+            return None
+        while True:
+            try:
+                ticks.append(self.streamer.prices.get_nowait())
+            except queue.Empty:
+                break
+
+        times = parse_times([tick['time'] for tick in ticks])
+        received = time()
+        for tick, now in zip(ticks, times.asi8):
+            self.set_quote(tick, received)
+            for aggregator in self.aggregators.get(
+                    tick['instrument'], {}).values():
+                aggregator.update(now, tick['bid'], tick['ask'])
+        # Complete the candles of the instruments which didn't tick
+        now = np.max(times.asi8)
+        for aggregators in self.aggregators.values():
+            for aggregator in aggregators.values():
+                aggregator.advance(now)
+        self.last_time = times.max().to_pydatetime()
+        return self.last_time
+
+    def get_history(self, *args, **kwargs):
+        aggregator = self.aggregators.get(
+            str(kwargs.get('instrument')), {}).get(kwargs.get('granularity'))
+        if args or aggregator is None or 'columns' in kwargs:
+            return super(OandaStreamingBroker, self).get_history(
+                *args, **kwargs)
+        return aggregator.history(
+            kwargs.get('start'), kwargs.get('end'),
+            kwargs.get('include_current', False))
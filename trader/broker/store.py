@@ -0,0 +1,301 @@
+import logging
+import os
+import shutil
+import threading
+import time
+import warnings
+
+import numpy as np
+import pandas as pd
+
+log = logging.getLogger('pyFx')
+
+
+def to_nanoseconds(dt):
+    return pd.Timestamp(dt).value
+
+
+def to_datetime(ns):
+    return pd.Timestamp(ns, tz='UTC').to_pydatetime()
+
+
+def select(df, start, end):
+    '''
+    Return a view on the candles of a sorted dataframe with
+    ``start < time <= end`` (as nanoseconds since the epoch).
+    '''
+    if df is None or df.empty:
+        return df
+    times = pd.DatetimeIndex(df.index).asi8
+    return df.iloc[times.searchsorted(start, side='right'):
+                   times.searchsorted(end, side='right')]
+
+
+def missing_ranges(coverage, start, end):
+    '''
+    Return the parts of the ]start, end] range which are not part of the
+    given sorted and disjoint ]start, end] ranges.
+    '''
+    gaps = []
+    cursor = start
+    for range_start, range_end in coverage:
+        if range_end <= cursor:
+            continue
+        if range_start >= end:
+            break
+        if range_start > cursor:
+            gaps.append((cursor, range_start))
+        cursor = range_end
+    if cursor < end:
+        gaps.append((cursor, end))
+    return gaps
+
+
+def merge_ranges(coverage):
+    '''
+    Merge overlapping and adjacent ranges into a sorted list of disjoint
+    ranges.
+    '''
+    merged = []
+    for range_start, range_end in sorted(coverage):
+        if merged and range_start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], range_end))
+        else:
+            merged.append((range_start, range_end))
+    return merged
+
+
+class CandleStore(object):
+    '''
+    Local store of the candles of an instrument and granularity, shared by
+    all backtests regardless of the strategy and date range they run. The
+    store keeps track of the time ranges it covers, so that only the gaps
+    of a requested range have to be downloaded. Stores can be loaded from
+    several threads, only the downloads run concurrently.
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.RLock()
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def filename(self, instrument, granularity):
+        return os.path.join(self.directory, 'candles-{}-{}.h5'.format(
+            instrument, granularity))
+
+    def _coverage(self, instrument, granularity):
+        '''
+        Return the list of covered ranges (as nanoseconds since the epoch).
+        '''
+        filename = self.filename(instrument, granularity)
+        if not os.path.exists(filename):
+            return []
+        store = pd.HDFStore(filename, mode='r')
+        try:
+            return [tuple(r) for r in store['coverage'].values.tolist()]
+        finally:
+            store.close()
+
+    def _read(self, instrument, granularity):
+        '''
+        Return all the stored candles and the list of covered ranges.
+        '''
+        filename = self.filename(instrument, granularity)
+        if not os.path.exists(filename):
+            return None, []
+        store = pd.HDFStore(filename, mode='r')
+        try:
+            df = store['candles']
+            coverage = [tuple(r) for r in store['coverage'].values.tolist()]
+        finally:
+            store.close()
+        return df, coverage
+
+    def _write(self, instrument, granularity, df, coverage):
+        filename = self.filename(instrument, granularity)
+        coverage = pd.DataFrame(coverage, columns=['start', 'end'])
+        with warnings.catch_warnings():
+            # The object columns get pickled
+            warnings.simplefilter('ignore', pd.io.pytables.PerformanceWarning)
+            store = pd.HDFStore(filename, mode='w')
+            try:
+                store['candles'] = df
+                store['coverage'] = coverage
+            finally:
+                store.close()
+
+    def _select(self, instrument, granularity, start, end):
+        '''
+        Return the stored candles with ``start < time <= end``.
+        '''
+        return select(self._read(instrument, granularity)[0], start, end)
+
+    def load(self, instrument, granularity, start, end, fetch,
+             complete_until=None):
+        '''
+        Return the candles with ``start < time <= end``. Missing ranges are
+        requested with ``fetch(instrument, granularity, start, end)`` and
+        added to the store. As more recent candles may not be complete yet,
+        ranges after ``complete_until`` are never marked as covered.
+        '''
+        start_ns, end_ns = to_nanoseconds(start), to_nanoseconds(end)
+        with self._lock:
+            coverage = self._coverage(instrument, granularity)
+            gaps = missing_ranges(coverage, start_ns, end_ns)
+            if not gaps:
+                return self._select(
+                    instrument, granularity, start_ns, end_ns)
+
+        frames = []
+        fetched = []
+        for gap_start, gap_end in gaps:
+            log.debug('fetching {}/{} candles from {} to {}'.format(
+                instrument, granularity, to_datetime(gap_start),
+                to_datetime(gap_end)))
+            frames.append(fetch(instrument, granularity,
+                                to_datetime(gap_start),
+                                to_datetime(gap_end)))
+            if complete_until is not None:
+                gap_end = min(gap_end, to_nanoseconds(complete_until))
+            if gap_start < gap_end:
+                fetched.append((gap_start, gap_end))
+
+        with self._lock:
+            ## the store may have been updated during the download
+            df, coverage = self._read(instrument, granularity)
+            coverage.extend(fetched)
+            if df is not None:
+                frames.insert(0, df)
+            df = pd.concat(frames).sort_index(kind='mergesort')
+            if not df.empty:
+                ## candles fetched again replace the stored ones
+                times = pd.DatetimeIndex(df.index).asi8
+                df = df[np.append(times[1:] != times[:-1], True)]
+            self._write(instrument, granularity, df, merge_ranges(coverage))
+            return self._select(instrument, granularity, start_ns, end_ns)
+
+
+class NumpyCandleStore(CandleStore):
+    '''
+    Candle store keeping every column in a raw numpy file of a fixed dtype,
+    which is memory-mapped when loaded: reading a range of candles only
+    reads that range instead of deserializing the whole store. The mappings
+    are copy-on-write, as pandas needs writable buffers for some operations;
+    changes never reach the files.
+
+    Every write creates a new version directory holding all the arrays and
+    then atomically points the ``current`` symlink to it, so readers (also
+    in other processes) always see a consistent set of arrays.
+    '''
+    price_columns = (
+        'closeBid',
+        'closeAsk',
+        'openBid',
+        'openAsk',
+        'highBid',
+        'highAsk',
+        'lowBid',
+        'lowAsk',
+        'closeMid',
+    )
+    array_names = ('time', 'volume', 'complete', 'prices', 'coverage')
+
+    def filename(self, instrument, granularity):
+        return os.path.join(self.directory, 'candles-{}-{}'.format(
+            instrument, granularity))
+
+    def _load_arrays(self, instrument, granularity, names=array_names):
+        '''
+        Map the given arrays of the current version of the store, or return
+        None if nothing was stored yet.
+        '''
+        directory = self.filename(instrument, granularity)
+        link = os.path.join(directory, 'current')
+        for attempt in range(3):
+            if not os.path.lexists(link):
+                return None
+            path = os.path.join(directory, os.readlink(link))
+            try:
+                return dict(
+                    (name, np.load(os.path.join(path, name + '.npy'),
+                                   mmap_mode='c'))
+                    for name in names)
+            except IOError:
+                ## replaced by another process in the meantime
+                continue
+        raise IOError('Could not read the candle store {}'.format(directory))
+
+    def _coverage(self, instrument, granularity):
+        arrays = self._load_arrays(instrument, granularity, ('coverage',))
+        if arrays is None:
+            return []
+        return [tuple(r) for r in arrays['coverage'].tolist()]
+
+    def _frame(self, arrays, first=0, last=None):
+        if last is None:
+            last = len(arrays['time'])
+        index = pd.DatetimeIndex(
+            np.asarray(arrays['time'][first:last]), tz='UTC')
+        ## wraps the mapped prices without copying them
+        df = pd.DataFrame(arrays['prices'][first:last],
+                          index=index, columns=self.price_columns)
+        df.insert(0, 'time', index.to_pydatetime())
+        df.insert(1, 'volume', np.array(arrays['volume'][first:last]))
+        df.insert(2, 'complete', np.array(arrays['complete'][first:last]))
+        return df
+
+    def _read(self, instrument, granularity):
+        arrays = self._load_arrays(instrument, granularity)
+        if arrays is None:
+            return None, []
+        return (self._frame(arrays),
+                [tuple(r) for r in arrays['coverage'].tolist()])
+
+    def _write(self, instrument, granularity, df, coverage):
+        directory = self.filename(instrument, granularity)
+        version = 'v{}-{}'.format(int(time.time() * 10**6), os.getpid())
+        os.makedirs(os.path.join(directory, version))
+        arrays = {
+            'time': pd.DatetimeIndex(df.index).asi8,
+            'volume': df['volume'].values.astype(np.int64),
+            'complete': df['complete'].values.astype(bool),
+            'prices': df.loc[:, self.price_columns].values.astype(
+                np.float64),
+            'coverage': np.array(coverage, dtype=np.int64).reshape(-1, 2),
+        }
+        for name, array in arrays.items():
+            np.save(os.path.join(directory, version, name + '.npy'), array)
+
+        link = os.path.join(directory, 'current')
+        tmp_link = '{}.{}.tmp'.format(link, os.getpid())
+        os.symlink(version, tmp_link)
+        os.rename(tmp_link, link)
+
+        ## mapped files of the previous versions stay readable until unmapped
+        for entry in os.listdir(directory):
+            if entry.startswith('v') and entry != version:
+                shutil.rmtree(os.path.join(directory, entry),
+                              ignore_errors=True)
+
+    def _select(self, instrument, granularity, start, end):
+        arrays = self._load_arrays(instrument, granularity)
+        if arrays is None:
+            return None
+        times = arrays['time']
+        return self._frame(arrays,
+                           int(times.searchsorted(start, side='right')),
+                           int(times.searchsorted(end, side='right')))
+
+
+STORE_BACKENDS = {
+    'hdf': CandleStore,
+    'numpy': NumpyCandleStore,
+}
+
+
+def get_store(backend, directory):
+    try:
+        return STORE_BACKENDS[backend](directory)
+    except KeyError:
+        raise ValueError('Invalid candle store backend: {}'.format(backend))
@@ -5,6 +5,7 @@ import errno
 import logging
 import os
 import sys
+from collections import OrderedDict
 from time import strftime, time
 from dateutil import parser
 
@@ -20,7 +21,11 @@ except ImportError:
 from .app_conf import settings
 from .broker.oanda_backtest import OandaBacktestBroker
 from .broker.oanda_live import OandaRealtimeBroker
-from .controller import Controller, SimulatedClock, IntervalClock
+from .broker.oanda_stream import OandaStreamingBroker, PriceStreamer
+from .backtest import (BacktestJob, make_jobs, merge_trades, parameter_grid,
+                       run_backtest, run_jobs, summarize, write_csv,
+                       write_report)
+from .controller import Controller, IntervalClock, StreamClock
 from .instruments import InstrumentParamType
 from .lib import oandapy
 from .portfolio import Portfolio
@@ -34,6 +39,101 @@ def hr(char='-', width=None, **kwargs):
     click.secho(char * width, **kwargs)
 
 
+class SweepParamType(click.ParamType):
+    """
+    A parameter search space, either as ``name=value1,value2,...`` or as an
+    inclusive integer range ``name=start:stop[:step]``.
+    """
+    name = 'parameter'
+
+    @staticmethod
+    def coerce(value):
+        for type_ in (int, float):
+            try:
+                return type_(value)
+            except ValueError:
+                pass
+        return value
+
+    def convert(self, value, param, ctx):
+        try:
+            name, spec = value.split('=', 1)
+            assert name and spec
+            if ':' in spec:
+                bounds = [int(v) for v in spec.split(':')]
+                assert len(bounds) in (2, 3)
+                start, stop, step = (bounds + [1])[:3]
+                values = list(range(start, stop + 1, step))
+            else:
+                values = [self.coerce(v) for v in spec.split(',')]
+            return name, values
+        except (AssertionError, ValueError):
+            self.fail('{} is not a valid parameter definition'.format(value),
+                      param, ctx)
+
+
+def setup_logging(log_level):
+    # Make urllib3 logger more calm
+    urllib3_logger = logging.getLogger('urllib3')
+    urllib3_logger.setLevel(logging.CRITICAL)
+
+    try:
+        os.makedirs('logs')
+    except OSError as exception:
+        if exception.errno != errno.EEXIST:
+            raise
+
+    numeric_level = getattr(logging, log_level.upper(), None)
+    if not isinstance(numeric_level, int):
+        raise ValueError('Invalid log level: %s' % log_level)
+    log_filename = "logs/pyfx_debug_{}-{}.log".format(
+        strftime("%Y_%m_%d-%H_%M"), settings.ENVIRONMENT)
+    logging.basicConfig(filename=log_filename, level=logging.DEBUG)
+
+    formatter = logging.Formatter(
+        "[%(asctime)s/%(levelname)s] %(funcName)s():%(lineno)d\t%(message)s")
+    handler = RainbowLoggingHandler(
+        sys.stdout, color_funcName=('black', 'yellow', True))
+    handler.setFormatter(formatter)
+    handler.setLevel(numeric_level)
+    log.addHandler(handler)
+
+
+def backtest_range(start_date=None, end_date=None):
+    start_date_ = start_date if start_date else settings.BACKTEST_START
+    end_date_ = end_date if end_date else settings.BACKTEST_END
+    return (parser.parse(start_date_).replace(tzinfo=pytz.utc),
+            parser.parse(end_date_).replace(tzinfo=pytz.utc))
+
+
+def load_backtest(instruments, start, end):
+    """
+    Create a backtest broker and a strategy for each instrument and load the
+    backtest buffers for the given range.
+    """
+    api = oandapy.API(
+        environment=settings.ENVIRONMENT,
+        access_token=settings.ACCESS_TOKEN,
+        pool_size=settings.BACKTEST_DOWNLOAD_THREADS,
+        # The downloaded pages of candles are never requested twice
+        cache=oandapy.ResponseCache(maxsize=0),
+    )
+    broker = OandaBacktestBroker(
+        api=api,
+        account_id=settings.ACCOUNT_ID,
+        initial_balance=decimal.Decimal(5000))
+
+    # TODO Optimize load of instrument info
+    instrument_list = set(instruments)
+    for inst in instrument_list:
+        inst.load(broker)
+    # TODO We have to be able to instantiate strategies with custom args
+    strategies = [settings.STRATEGY(instrument)
+                  for instrument in instrument_list]
+    broker.init_backtest(start, end, strategies)
+    return broker, strategies
+
+
 @click.command()
 @click.option('--instrument', '-i', 'instruments',
               default=settings.DEFAULT_INSTRUMENTS,
@@ -43,6 +143,29 @@ def hr(char='-', width=None, **kwargs):
               type=click.Choice(['backtest', 'live']))
 @click.option('--start', '-s', 'start_date', )
 @click.option('--end', '-e', 'end_date', )
+@click.option('--clock', '-c', 'clock_type',
+              default=settings.BACKTEST_CLOCK,
+              type=click.Choice(['candle', 'interval']),
+              help=('Backtest clock: tick on new candles only, or every '
+                    'CLOCK_INTERVAL seconds.'))
+@click.option('--vectorized/--no-vectorized', 'vectorized',
+              default=settings.BACKTEST_VECTORIZED,
+              help=('Compute the strategy indicators once over the whole '
+                    'backtest feeds instead of on every tick.'))
+@click.option('--workers', '-w', 'workers', type=int,
+              default=settings.BACKTEST_WORKERS,
+              help=('Number of processes to spread the backtested '
+                    'instruments across.'))
+@click.option('--shard-days', 'shard_days', type=int,
+              default=settings.BACKTEST_SHARD_DAYS,
+              help=('Split the backtest into windows of this many days, '
+                    'run by the worker processes. Positions open at the end '
+                    'of a window are run until they close.'))
+@click.option('--stream/--no-stream', 'stream',
+              default=settings.LIVE_STREAMING,
+              help=('Live mode: build the candles from the rate stream and '
+                    'tick on every price update instead of polling the API '
+                    'every CLOCK_INTERVAL seconds.'))
 @click.option('--log', '-l', 'log_level',
               default='info',
               type=click.Choice(['info', 'debug', 'warning', ]))
@@ -51,8 +174,8 @@ def hr(char='-', width=None, **kwargs):
                     'an exception.'))
 @click.option('--step', default=False, is_flag=True,
               help='Step into debugger at the start of the program')
-def main(instruments, mode, log_level, debug, step, start_date=None,
-         end_date=None):
+def main(instruments, mode, log_level, debug, step, clock_type, vectorized,
+         workers, shard_days, stream, start_date=None, end_date=None):
     """
     Algorithmic trading tool.
     """
@@ -75,78 +198,141 @@ def main(instruments, mode, log_level, debug, step, start_date=None,
     if step:
         pdb.set_trace()
 
-    # Make urllib3 logger more calm
-    urllib3_logger = logging.getLogger('urllib3')
-    urllib3_logger.setLevel(logging.CRITICAL)
-
-    try:
-        os.makedirs('logs')
-    except OSError as exception:
-        if exception.errno != errno.EEXIST:
-            raise
-
-    numeric_level = getattr(logging, log_level.upper(), None)
-    if not isinstance(numeric_level, int):
-        raise ValueError('Invalid log level: %s' % log_level)
-    log_filename = "logs/pyfx_debug_{}-{}.log".format(
-        strftime("%Y_%m_%d-%H_%M"), settings.ENVIRONMENT)
-    logging.basicConfig(filename=log_filename, level=logging.DEBUG)
-
-    formatter = logging.Formatter(
-        "[%(asctime)s/%(levelname)s] %(funcName)s():%(lineno)d\t%(message)s")
-    handler = RainbowLoggingHandler(
-        sys.stdout, color_funcName=('black', 'yellow', True))
-    handler.setFormatter(formatter)
-    handler.setLevel(numeric_level)
-    log.addHandler(handler)
-
-    start_date_ = start_date if start_date else settings.BACKTEST_START
-    end_date_ = end_date if end_date else settings.BACKTEST_END
-    BACKTEST_START = parser.parse(start_date_).replace(tzinfo=pytz.utc)
-    BACKTEST_END = parser.parse(end_date_).replace(tzinfo=pytz.utc)
+    setup_logging(log_level)
+    BACKTEST_START, BACKTEST_END = backtest_range(start_date, end_date)
 
     if mode == 'backtest':
-        api = oandapy.API(
-            environment=settings.ENVIRONMENT,
-            access_token=settings.ACCESS_TOKEN,
-        )
-        broker = OandaBacktestBroker(
-            api=api,
-            account_id=settings.ACCOUNT_ID,
-            initial_balance=decimal.Decimal(5000))
-
-        # Oanda 20:00, Local: 22:00, DailyFx: 16:00
-        clock_interval = settings.CLOCK_INTERVAL
-        log.info('Starting simulated clock with interval {} seconds'.format(clock_interval))
-        clock = SimulatedClock(
-            start=BACKTEST_START,
-            stop=BACKTEST_END,
-            interval=clock_interval,
-        )
+        broker, strategies = load_backtest(
+            instruments, BACKTEST_START, BACKTEST_END)
+
+        if workers > 1 or shard_days:
+            # Instruments don't interact, so each one (and each date range
+            # shard) can run in its own process
+            jobs = make_jobs([s.instrument for s in strategies],
+                             BACKTEST_START, BACKTEST_END, shard_days)
+            results = run_jobs(broker, jobs, workers,
+                               clock_type=clock_type, vectorized=vectorized)
+            write_report(merge_trades(results))
+        else:
+            run_backtest(broker, [s.instrument for s in strategies],
+                         BACKTEST_START, BACKTEST_END, clock_type=clock_type,
+                         vectorized=vectorized, write_csv=True)
 
     elif mode == 'live':
         api = oandapy.API(
             environment=settings.ENVIRONMENT,
             access_token=settings.ACCESS_TOKEN,
         )
-        clock = IntervalClock(interval=settings.CLOCK_INTERVAL)
-        broker = OandaRealtimeBroker(api=api, account_id=settings.ACCOUNT_ID)
+        if stream:
+            streamer = PriceStreamer(
+                environment=settings.ENVIRONMENT,
+                access_token=settings.ACCESS_TOKEN,
+            )
+            broker = OandaStreamingBroker(
+                api=api, streamer=streamer, account_id=settings.ACCOUNT_ID)
+            clock = StreamClock(broker, timeout=settings.CLOCK_INTERVAL)
+        else:
+            broker = OandaRealtimeBroker(
+                api=api, account_id=settings.ACCOUNT_ID)
+            clock = IntervalClock(interval=settings.CLOCK_INTERVAL)
+
+        # TODO Optimize load of instrument info
+        instrument_list = set(instruments)
+        for inst in instrument_list:
+            inst.load(broker)
+        # TODO We have to be able to instantiate strategies with custom args
+        strategies = [settings.STRATEGY(instrument)
+                      for instrument in instrument_list]
+        if stream:
+            broker.start_streaming(strategies)
+        pf = Portfolio(broker, mode='live')
+        controller = Controller(clock, broker, pf, strategies)
+        try:
+            controller.run_until_stopped()
+        finally:
+            if stream:
+                broker.stop_streaming()
+            if pf.notifier:
+                pf.notifier.close()
     else:
         raise NotImplementedError()
 
-    # TODO Optimize load of instrument info
-    instrument_list = set(instruments)
-    for inst in instrument_list:
-        inst.load(broker)
-    # TODO We have to be able to instantiate strategies with custom args
-    strategies = [settings.STRATEGY(instrument)
-                  for instrument in instrument_list]
-    if mode == 'backtest':
-        broker.init_backtest(BACKTEST_START, BACKTEST_END, strategies)
-        pf = Portfolio(broker, mode='backtest')
-    else:
-        pf = Portfolio(broker, mode='live')
-    controller = Controller(clock, broker, pf, strategies)
-    controller.run_until_stopped()
+    log.info('script duration: {:.2f}s'.format(time() - _start_time))
+
+
+@click.command()
+@click.option('--instrument', '-i', 'instruments',
+              default=settings.DEFAULT_INSTRUMENTS,
+              multiple=True,
+              type=InstrumentParamType())
+@click.option('--start', '-s', 'start_date', )
+@click.option('--end', '-e', 'end_date', )
+@click.option('--param', '-p', 'params', multiple=True, required=True,
+              type=SweepParamType(),
+              help=('Strategy attribute (e.g. sma_intervals.sma_fast) or '
+                    'setting read by the strategy, and its values, as '
+                    'name=v1,v2,... or name=start:stop[:step].'))
+@click.option('--samples', '-n', 'samples', type=int, default=None,
+              help=('Run this many randomly chosen combinations instead of '
+                    'the whole grid.'))
+@click.option('--seed', 'seed', type=int, default=None)
+@click.option('--clock', '-c', 'clock_type',
+              default=settings.BACKTEST_CLOCK,
+              type=click.Choice(['candle', 'interval']))
+@click.option('--vectorized/--no-vectorized', 'vectorized',
+              default=settings.BACKTEST_VECTORIZED)
+@click.option('--workers', '-w', 'workers', type=int,
+              default=settings.BACKTEST_WORKERS)
+@click.option('--log', '-l', 'log_level',
+              default='warning',
+              type=click.Choice(['info', 'debug', 'warning', ]))
+def sweep(instruments, params, samples, seed, clock_type, vectorized,
+          workers, log_level, start_date=None, end_date=None):
+    """
+    Backtest combinations of strategy parameters over the same candles and
+    rank them by profit.
+    """
+    _start_time = time()
+    setup_logging(log_level)
+    BACKTEST_START, BACKTEST_END = backtest_range(start_date, end_date)
+
+    space = OrderedDict(params)
+    for name in space:
+        if name.isupper():
+            valid = name in settings.STRATEGY.setting_names
+        else:
+            valid = hasattr(settings.STRATEGY, name.partition('.')[0])
+        if not valid:
+            raise click.BadParameter(
+                '{} is neither a setting read by {} nor one of its '
+                'attributes'.format(name, settings.STRATEGY.__name__),
+                param_hint='--param')
+
+    # The candles are loaded once and shared by all the forked workers
+    broker, strategies = load_backtest(
+        instruments, BACKTEST_START, BACKTEST_END)
+    names = sorted(str(s.instrument) for s in strategies)
+    jobs = [BacktestJob(names, BACKTEST_START, BACKTEST_END, combination)
+            for combination in parameter_grid(space, samples, seed)]
+    results = run_jobs(broker, jobs, workers,
+                       clock_type=clock_type, vectorized=vectorized)
+
+    ranking = []
+    for job, trades in zip(jobs, results):
+        row = summarize(merge_trades([trades]))
+        row.update(job.params)
+        ranking.append(row)
+    ranking.sort(key=lambda r: (-r['profit'], r['max_drawdown']))
+    write_csv('logs/sweep-{}.csv'.format(strftime("%Y%m%d-%H%M%S")),
+              ranking)
+
+    columns = ['rank'] + list(ranking[0].keys())
+    rows = [[i + 1] + list(row.values()) for i, row in enumerate(ranking)]
+    widths = [max(len(str(v)) for v in column)
+              for column in zip(columns, *rows)]
+    click.echo('  '.join(c.rjust(w) for c, w in zip(columns, widths)))
+    hr(width=sum(widths) + 2 * (len(widths) - 1))
+    for row in rows:
+        click.echo('  '.join(str(v).rjust(w) for v, w in zip(row, widths)))
 
     log.info('script duration: {:.2f}s'.format(time() - _start_time))
@@ -1,3 +1,4 @@
+import math
 import multiprocessing
 
 import os
@@ -8,6 +9,7 @@ from datetime import datetime, timedelta
 from time import sleep
 
 import click
+import pytz
 
 
 log = logging.getLogger('pyFx')
@@ -36,6 +38,63 @@ class SimulatedClock(object):
             current += self.interval
 
 
+class CandleClock(object):
+    """
+    Simulated clock which only ticks when at least one of the backtest feeds
+    has a new candle available, instead of stepping through every interval
+    (including weekends and other periods without any trading data).
+
+    The first tick is always ``start``; the remaining ticks are requested
+    lazily from the broker, so that the clock can be created before the
+    backtest buffers are loaded. With a ``step``, ticks are delayed to the
+    next multiple of ``step`` after ``start``, which is when strategies
+    acting every ``step`` would see the new candles on a SimulatedClock
+    started at ``start``. Only the feeds of ``instruments`` (all of them by
+    default) make the clock tick.
+    """
+
+    def __init__(self, start, stop, broker, step=None, instruments=None):
+        self.start = start
+        self.stop = stop
+        self.broker = broker
+        self.step = step
+        self.instruments = instruments
+
+    def __iter__(self):
+        yield self.start
+        last = self.start
+        for tick in self.broker.get_candle_ticks(
+                self.start, self.stop, self.instruments):
+            if self.step:
+                steps = math.ceil((tick - self.start).total_seconds() /
+                                  self.step.total_seconds())
+                tick = self.start + int(steps) * self.step
+                if tick >= self.stop:
+                    break
+            if tick > last:
+                last = tick
+                yield tick
+
+
+class StreamClock(object):
+    """
+    Live clock ticking on the prices received by a streaming broker (see
+    OandaStreamingBroker) instead of every few seconds. The prices received
+    while the controller was busy are applied at once and make a single tick.
+    Without prices for ``timeout`` seconds (e.g. when the market is closed),
+    the clock ticks on the current time.
+    """
+
+    def __init__(self, broker, timeout):
+        self.broker = broker
+        self.timeout = timeout
+
+    def __iter__(self):
+        while True:
+            tick = self.broker.wait_for_prices(self.timeout)
+            yield tick or datetime.utcnow().replace(tzinfo=pytz.utc)
+
+
 class ControllerBase(object):
     """
     A controller class takes care to run the actions returned by the strategies
@@ -1,6 +1,19 @@
+import heapq
+import itertools
 import json
+import random
 import requests
 import logging
+import threading
+import time
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+from requests.packages.urllib3.exceptions import ProtocolError
+try:
+    from OpenSSL.SSL import SysCallError
+except ImportError:
+    SysCallError = ProtocolError
 
 """ OANDA API wrapper for OANDA's REST API """
 
@@ -10,6 +23,7 @@ E.g. oandapy_instance.get_instruments(instruments="EUR_USD")
 """
 
 logging.getLogger("requests").setLevel(logging.WARNING)
+log = logging.getLogger('pyFx')
 
 class EndpointsMixin(object):
 
@@ -204,13 +218,209 @@ class EndpointsMixin(object):
         return self.request(endpoint, params=params)
         
 
+""" Schedules the requests of an API instance """
+
+class RequestScheduler(object):
+    """ Rate limits the requests with a token bucket, serving the waiting
+    requests by priority lane (ORDERS, then QUOTES, then BULK), and retries
+    the failed ones with a jittered exponential backoff.
+    The counters count the requests made, the ones which had to wait for a
+    token (throttled), the retries and the requests which finally failed.
+    """
+    ORDERS, QUOTES, BULK = 0, 1, 2
+
+    ## responses meaning that the request was not processed
+    retry_statuses = (429, 503)
+    ## responses worth retrying for reads only
+    read_retry_statuses = (500, 502, 504)
+    ## connection errors, only retried for reads
+    errors = (requests.RequestException, ProtocolError, SysCallError)
+
+    def __init__(self, rate=15, burst=None, max_retries=3, max_read_retries=None, base_delay=0.5, max_delay=30):
+        """
+        :param rate: (optional) Requests allowed per second. Default: 15
+        :param burst: (optional) Requests allowed at once. Default: rate
+        :param max_retries: (optional) Retries of a failed write (POST, PATCH or DELETE), only done when the API refused it (429 or 503). Default: 3
+        :param max_read_retries: (optional) Retries of a failed GET, also done on connection errors and server errors. Default: None (until it succeeds)
+        :param base_delay: (optional) Delay before the first retry, doubled for each next one, in seconds. Default: 0.5
+        :param max_delay: (optional) Maximum delay between retries, in seconds. Default: 30
+        """
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.max_retries = max_retries
+        self.max_read_retries = max_read_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.waiting = []
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.counters = dict.fromkeys(
+            ('requests', 'throttled', 'retried', 'failed'), 0)
+
+    def _count(self, counter):
+        with self.condition:
+            self.counters[counter] += 1
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, priority):
+        """ Waits for a token, after the requests of a higher priority (and
+        the older ones of the same priority) waiting for one
+        """
+        with self.condition:
+            waiter = (priority, next(self.sequence))
+            heapq.heappush(self.waiting, waiter)
+            throttled = False
+            while True:
+                self._refill()
+                if self.waiting[0] == waiter and self.tokens >= 1:
+                    break
+                throttled = True
+                timeout = (1 - self.tokens) / self.rate \
+                    if self.waiting[0] == waiter else None
+                self.condition.wait(timeout)
+            heapq.heappop(self.waiting)
+            self.tokens -= 1
+            self.counters['requests'] += 1
+            if throttled:
+                self.counters['throttled'] += 1
+            # Let the next waiter check for a token
+            self.condition.notify_all()
+
+    def backoff(self, attempt):
+        """ Returns the delay before the given retry (starting at 1) """
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return random.uniform(delay / 2, delay)
+
+    def run(self, send, method, priority):
+        """ Sends a request (send() returning a response) when the rate limit
+        allows it and retries it if needed. Returns the last response or
+        raises the last connection error.
+        """
+        is_read = method == 'get'
+        max_retries = self.max_read_retries if is_read else self.max_retries
+        attempt = 0
+        while True:
+            self.acquire(priority)
+            error = response = None
+            try:
+                response = send()
+            except self.errors as e:
+                error = e
+            retry = (response is not None and (
+                response.status_code in self.retry_statuses or
+                is_read and response.status_code in
+                self.read_retry_statuses)) or (error is not None and is_read)
+            if not retry:
+                break
+            if max_retries is not None and attempt >= max_retries:
+                self._count('failed')
+                break
+            attempt += 1
+            self._count('retried')
+            delay = self.backoff(attempt)
+            log.warning("[!] Request failed ({}), retrying in {:.1f}s".format(
+                error or response.status_code, delay))
+            time.sleep(delay)
+        if error is not None:
+            if not is_read:
+                self._count('failed')
+            raise error
+        return response
+
+
+""" Caches the responses of an API instance """
+
+class ResponseCache(object):
+    """ Bounded LRU cache of the GET responses, by endpoint and parameters.
+    A response is served from the cache for the TTL of its endpoint, then
+    revalidated with its ETag (If-None-Match) or Last-Modified date
+    (If-Modified-Since): a 304 answer serves it again without transferring
+    or decoding it. The cached responses are shared, they must not be
+    modified.
+    The endpoints containing one of the excluded parts (orders, trades,
+    positions and transactions, whose state matters) are never cached.
+    """
+    exclude = ('/orders', '/trades', '/positions', '/transactions')
+    ## seconds during which a response is served without revalidating it,
+    ## by endpoint (those not listed are always revalidated)
+    default_ttls = {
+        'v1/instruments': 3600,
+    }
+
+    def __init__(self, maxsize=64, ttls=None):
+        """
+        :param maxsize: (optional) Number of responses kept. Default: 64
+        :param ttls: (optional) TTLs overriding the default ones, by endpoint. Default: None
+        """
+        self.maxsize = maxsize
+        self.ttls = dict(self.default_ttls, **(ttls or {}))
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = dict.fromkeys(('hits', 'revalidated', 'misses'), 0)
+
+    def accepts(self, endpoint):
+        return self.maxsize > 0 and \
+            not any(part in endpoint for part in self.exclude)
+
+    def key(self, endpoint, params):
+        return endpoint, tuple(sorted(params.items()))
+
+    def get(self, key):
+        """ Returns the cached entry of a request (content, ETag,
+        Last-Modified date, expiry) or None
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.counters['misses'] += 1
+                return None
+            self.entries[key] = entry
+            if entry[3] > time.time():
+                self.counters['hits'] += 1
+            return entry
+
+    def revalidated(self, key):
+        """ Returns the content of an entry confirmed by a 304, renewing it
+        """
+        with self.lock:
+            content, etag, modified, expiry = self.entries[key]
+            self.entries[key] = (content, etag, modified,
+                                 time.time() + self.ttls.get(key[0], 0))
+            self.counters['revalidated'] += 1
+            return content
+
+    def put(self, key, content, response):
+        etag = response.headers.get('ETag')
+        modified = response.headers.get('Last-Modified')
+        ttl = self.ttls.get(key[0], 0)
+        if not (etag or modified or ttl):
+            return
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (content, etag, modified, time.time() + ttl)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+
 """ Provides functionality for access to core OANDA API calls """
 
 class API(EndpointsMixin, object):
-    def __init__(self, environment="practice", access_token=None, headers=None):
+    def __init__(self, environment="practice", access_token=None, headers=None, pool_size=None, api_url=None, timeout=None, scheduler=None, cache=None):
         """Instantiates an instance of OandaPy's API wrapper
         :param environment: (optional) Provide the environment for oanda's REST api, either 'sandbox', 'practice', or 'live'. Default: practice
         :param access_token: (optional) Provide a valid access token if you have one. This is required if the environment is not sandbox.
+        :param pool_size: (optional) Number of connections kept open to the API, to be shared by concurrent requests. Default: requests' default (10)
+        :param api_url: (optional) Base URL of the API, overriding the one of the environment (e.g. a local stub server). Default: None
+        :param timeout: (optional) Timeout of the requests, in seconds. Default: None (no timeout)
+        :param scheduler: (optional) RequestScheduler rate limiting and retrying the requests. Default: RequestScheduler()
+        :param cache: (optional) ResponseCache of the GET responses, ResponseCache(maxsize=0) disabling it. Default: ResponseCache()
         """
 
         if environment == 'sandbox':
@@ -219,9 +429,19 @@ class API(EndpointsMixin, object):
             self.api_url = 'https://api-fxpractice.oanda.com'
         elif environment == 'live':
             self.api_url = 'https://api-fxtrade.oanda.com'
+        if api_url:
+            self.api_url = api_url.rstrip('/')
 
         self.access_token = access_token
+        self.timeout = timeout
+        self.scheduler = scheduler or RequestScheduler()
+        self.cache = cache if cache is not None else ResponseCache()
         self.client = requests.Session()
+        if pool_size:
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=1, pool_maxsize=pool_size)
+            self.client.mount('http://', adapter)
+            self.client.mount('https://', adapter)
 
         #personal token authentication
         if self.access_token:
@@ -230,7 +450,7 @@ class API(EndpointsMixin, object):
         if headers:
             self.client.headers.update(headers)
 
-    def request(self, endpoint, method='GET', params=None):
+    def request(self, endpoint, method='GET', params=None, priority=None, cache=True):
         """Returns dict of response from OANDA's open API
         :param endpoint: (required) OANDA API endpoint (e.g. v1/instruments)
         :type endpoint: string
@@ -238,6 +458,10 @@ class API(EndpointsMixin, object):
         :type method: string
         :param params: (optional) Dict of parameters (if any) accepted the by OANDA API endpoint you are trying to access (default None)
         :type params: dict or None
+        :param priority: (optional) Lane of the request in the scheduler. Default: see request_priority
+        :type priority: int or None
+        :param cache: (optional) Whether the response of a GET may come from (and go to) the cache, see ResponseCache. Default: True
+        :type cache: bool
         """
 
         url = '%s/%s' % ( self.api_url, endpoint)
@@ -247,26 +471,107 @@ class API(EndpointsMixin, object):
 
         func = getattr(self.client, method)
 
-        request_args = {}
+        request_args = {'timeout': self.timeout}
         if method == 'get':
             request_args['params'] = params
         else:
             request_args['data'] = params
 
+        key = entry = None
+        if method == 'get' and cache and self.cache.accepts(endpoint):
+            key = self.cache.key(endpoint, params)
+            entry = self.cache.get(key)
+        if entry is not None:
+            content, etag, modified, expiry = entry
+            if expiry > time.time():
+                return content
+            request_args['headers'] = {}
+            if etag:
+                request_args['headers']['If-None-Match'] = etag
+            if modified:
+                request_args['headers']['If-Modified-Since'] = modified
+
+        if priority is None:
+            priority = self.request_priority(endpoint, method)
         try:
-            response = func(url, **request_args)
-        except requests.RequestException as e:
-            print (str(e))
+            response = self.scheduler.run(
+                lambda: func(url, **request_args), method, priority)
+        except RequestScheduler.errors as e:
+            raise OandaError({'code': None, 'message': str(e)})
+        if response.status_code == 304 and entry is not None:
+            return self.cache.revalidated(key)
         content = response.content.decode('utf-8')
 
-        content = json.loads(content)
+        try:
+            content = json.loads(content)
+        except ValueError:
+            if response.status_code < 400:
+                raise
+            content = {'code': response.status_code, 'message': content}
 
         # error message
         if response.status_code >= 400:
             raise OandaError(content)
 
+        if key is not None and response.status_code == 200:
+            self.cache.put(key, content, response)
         return content
 
+    def request_priority(self, endpoint, method):
+        """ Returns the scheduler lane of a request: orders and closes first,
+        then the other requests except the candles, which come last
+        """
+        if method != 'get':
+            return RequestScheduler.ORDERS
+        if endpoint.endswith('/candles'):
+            return RequestScheduler.BULK
+        return RequestScheduler.QUOTES
+
+    @property
+    def counters(self):
+        """ Counters of the scheduler, see RequestScheduler """
+        return dict(self.scheduler.counters)
+
+class AsyncAPI(API):
+    """ Non-blocking counterpart of API: every endpoint returns at once an
+    AsyncResult (see multiprocessing.pool), whose get() method waits for
+    the response and returns it or raises its error.
+    The requests run on a pool of threads sharing the kept-alive connections
+    to the API, so at most max_concurrency of them are in flight.
+    """
+
+    def __init__(self, environment="practice", access_token=None, headers=None, max_concurrency=10, api_url=None, timeout=30, scheduler=None, cache=None):
+        """Instantiates an instance of OandaPy's non-blocking API wrapper
+        :param max_concurrency: (optional) Maximum number of concurrent requests (and of connections kept open). Default: 10
+        See API for the other parameters.
+        """
+        super(AsyncAPI, self).__init__(
+            environment=environment, access_token=access_token,
+            headers=headers, pool_size=max_concurrency, api_url=api_url,
+            timeout=timeout, scheduler=scheduler, cache=cache)
+        self.pool = ThreadPool(processes=max_concurrency)
+
+    def request(self, endpoint, method='GET', params=None, priority=None, cache=True):
+        """Returns an AsyncResult of the response from OANDA's open API
+        See API.request for the parameters.
+        """
+        return self.pool.apply_async(
+            super(AsyncAPI, self).request,
+            (endpoint, method, params, priority, cache))
+
+    def gather(self, results, timeout=None):
+        """Waits for several requests and returns their responses in order
+        :param results: (required) AsyncResults returned by the endpoints
+        :param timeout: (optional) Seconds to wait for each of them. Default: None
+        """
+        return [result.get(timeout) for result in results]
+
+    def close(self):
+        """ Waits for the pending requests and stops the threads
+        """
+        self.pool.close()
+        self.pool.join()
+
 """HTTPS Streaming"""
 
 class Streamer(object):
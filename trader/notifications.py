@@ -0,0 +1,181 @@
+import io
+import logging
+import threading
+import time
+from datetime import datetime
+
+from six.moves import queue
+
+from .app_conf import settings
+
+log = logging.getLogger('pyFx')
+
+
+class Sink(object):
+    '''
+    Destination of the notifications, receiving them in batches.
+    '''
+    def send(self, messages):
+        raise NotImplementedError()
+
+
+class TelegramSink(Sink):
+    ## maximum length of a Telegram message
+    max_length = 4096
+
+    def __init__(self, token, chat_id):
+        import telegram
+        self.bot = telegram.Bot(token=token)
+        self.chat_id = chat_id
+
+    def send(self, messages):
+        # One message per batch, unless it gets too long
+        text = ''
+        for message in messages:
+            if text and len(text) + len(message) + 1 > self.max_length:
+                self.bot.sendMessage(chat_id=self.chat_id, text=text)
+                text = ''
+            text = '\n'.join((text, message)) if text else message
+        if text:
+            self.bot.sendMessage(chat_id=self.chat_id, text=text)
+
+
+class FileSink(Sink):
+    def __init__(self, path):
+        self.path = path
+
+    def send(self, messages):
+        now = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        with io.open(self.path, 'a', encoding='utf-8') as f:
+            for message in messages:
+                if isinstance(message, bytes):
+                    message = message.decode('utf-8')
+                f.write(u'{} {}\n'.format(now, message))
+
+
+class StubSink(Sink):
+    '''
+    Keeps the notifications in memory, for tests and dry runs.
+    '''
+    def __init__(self):
+        self.batches = []
+
+    @property
+    def messages(self):
+        return [message for batch in self.batches for message in batch]
+
+    def send(self, messages):
+        self.batches.append(list(messages))
+
+
+def coalesce(messages):
+    '''
+    Merge the repetitions of a message in a batch, keeping the order of
+    their first occurrence.
+    '''
+    counts = {}
+    order = []
+    for message in messages:
+        if message not in counts:
+            order.append(message)
+            counts[message] = 0
+        counts[message] += 1
+    return [message if counts[message] == 1 else
+            '{} (x{})'.format(message, counts[message])
+            for message in order]
+
+
+class Notifier(object):
+    '''
+    Sends the notifications to a sink from a background thread, so that the
+    trading loop never waits for it. The notifications are queued (the
+    newest ones are dropped when the queue is full) and the ones arriving
+    within ``batch_delay`` seconds of each other are sent together.
+    '''
+    _stop = object()
+
+    def __init__(self, sink, maxsize=100, batch_delay=1.0, max_batch=20):
+        self.sink = sink
+        self.batch_delay = batch_delay
+        self.max_batch = max_batch
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def notify(self, message):
+        '''
+        Queue a message, returning False if the queue is full.
+        '''
+        try:
+            self.queue.put_nowait(message)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            log.warning("[!] Notification queue full, dropping: "
+                        "{}".format(message))
+            return False
+
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.time() + self.batch_delay
+        while batch[-1] is not self._stop and len(batch) < self.max_batch:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self._next_batch()
+            stop = batch[-1] is self._stop
+            messages = [m for m in batch if m is not self._stop]
+            if messages:
+                try:
+                    self.sink.send(coalesce(messages))
+                    self.sent += len(messages)
+                except Exception as e:
+                    self.failed += len(messages)
+                    log.warning("NOTIFICATION ERROR: {}".format(e))
+            if stop:
+                return
+
+    def close(self, timeout=5):
+        '''
+        Send the queued notifications and stop the background thread,
+        waiting up to ``timeout`` seconds.
+        '''
+        try:
+            self.queue.put(self._stop, timeout=timeout)
+        except queue.Full:
+            pass
+        self.thread.join(timeout)
+
+
+def make_notifier(sink=None):
+    '''
+    Return a notifier for the sink named by the NOTIFICATION_SINK setting
+    ('telegram', 'file', 'stub' or 'none'), or None for 'none'.
+    '''
+    sink = sink or settings.NOTIFICATION_SINK
+    if sink == 'none':
+        return None
+    if sink == 'telegram':
+        sink = TelegramSink(settings.TELEGRAM_TOKEN,
+                            settings.TELEGRAM_CHAT_ID)
+    elif sink == 'file':
+        sink = FileSink(settings.NOTIFICATION_FILE)
+    elif sink == 'stub':
+        sink = StubSink()
+    else:
+        raise ValueError('Unknown notification sink {!r}'.format(sink))
+    return Notifier(sink,
+                    maxsize=settings.NOTIFICATION_QUEUE_SIZE,
+                    batch_delay=settings.NOTIFICATION_BATCH_DELAY)
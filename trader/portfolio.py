@@ -7,8 +7,10 @@ from decimal import Decimal
 import itertools
 import time
 import logging
+from multiprocessing.pool import ThreadPool
 
 from .app_conf import settings
+from .notifications import make_notifier
 from .utils import assert_decimal
 
 log = logging.getLogger('pyFx')
@@ -22,13 +24,19 @@ class Open(object):
         self.order_type = order_type
 
     def __call__(self, portfolio):
-        portfolio.open_order(
+        return self.apply(portfolio, self.submit(portfolio))
+
+    def submit(self, portfolio):
+        return portfolio.submit_open(
             strategy=self.strategy,
             side=self.side,
             order_type=self.order_type,
             price=self.price,
         )
 
+    def apply(self, portfolio, positions):
+        return portfolio.apply_open(self.strategy, positions)
+
 
 class Close(object):
     def __init__(self, strategy, price):
@@ -36,38 +44,52 @@ class Close(object):
         self.price = assert_decimal(price)
 
     def __call__(self, portfolio):
-        portfolio.close_trade(self.strategy, price=self.price)
+        return self.apply(portfolio, self.submit(portfolio))
+
+    def submit(self, portfolio):
+        return portfolio.submit_close(self.strategy, price=self.price)
+
+    def apply(self, portfolio, results):
+        return portfolio.apply_close(self.strategy, results)
 
 
 class Portfolio(object):
-    def __init__(self, broker, mode='live'):
+    def __init__(self, broker, mode='live', write_csv=True, notifier=None):
 
         self.broker = broker
         self.mode = mode
 
         self.pending_order_list = []  # Pending orders
         self.position_list = []  # Confirmed transactions
+        # Without write_csv the closed trades are kept in memory only
+        self.write_csv = write_csv
         self.csv_out_file = 'logs/backtest_log-{}.csv'.format(
             time.strftime("%Y%m%d-%H%M%S"))
 
-        if mode == 'live':
-            import telegram
-            self.telegram = telegram.Bot(token=settings.TELEGRAM_TOKEN)
+        self.notifier = notifier
+        ## threads sending the live orders, see run_concurrently()
+        self._pool = None
+        if mode == 'live' and notifier is None:
+            self.notifier = make_notifier()
 
     def send_bot(self, message):
-        if self.mode == 'live' and self.telegram:
-            try:
-                self.telegram.sendMessage(
-                    chat_id=settings.TELEGRAM_CHAT_ID,
-                    text=message)
-                return True
-            except Exception, e:
-                log.warn("TELEGRAM ERROR: {}".format(e))
+        # Only queued here, see trader.notifications.Notifier
+        if self.mode == 'live' and self.notifier:
+            return self.notifier.notify(message)
         return False
 
     def open_order(self, strategy, side, order_type,
                    price=None, expiry=None, stop_loss=None):
-
+        return self.apply_open(strategy, self.submit_open(
+            strategy, side, order_type, price, expiry, stop_loss))
+
+    def submit_open(self, strategy, side, order_type,
+                    price=None, expiry=None, stop_loss=None):
+        '''
+        Send the orders of an Open operation to the broker, returning the
+        positions opened (or None for the failed orders) without registering
+        them, see apply_open().
+        '''
         units = self.calculate_position_size(strategy.instrument)
 
         if (not stop_loss and settings.PF_USE_STOPLOSS_CALC):
@@ -100,28 +122,7 @@ class Portfolio(object):
                 expiry=expiry,
                 stop_loss=stoploss_price,
             )
-            if position_1:
-                strategy.open_position(position_1)
-                self.pending_order_list.append(position_1)
-                open_msg = "Open 1/2 {} ORDER #{} for {}/{} at {}".format(
-                    position_1.side,
-                    position_1.order_id, position_1.instrument,
-                    position_1.open_price,
-                    position_1.open_time)
-                log.info(open_msg)
-                self.send_bot(open_msg)
-            if position_2:
-                strategy.open_position(position_2)
-                self.pending_order_list.append(position_2)
-                open_msg = "Open 2/2 {} ORDER #{} for {}/{} at {}".format(
-                    position_2.side,
-                    position_2.order_id, position_2.instrument,
-                    position_2.open_price,
-                    position_2.open_time)
-                log.info(open_msg)
-                self.send_bot(open_msg)
-            if position_1 and position_2:
-                return True
+            return [position_1, position_2]
         else:
             position = self.broker.open_order(
                 instrument=strategy.instrument,
@@ -133,32 +134,58 @@ class Portfolio(object):
                 stop_loss=stoploss_price,
                 take_profit=takeprofit_price,
             )
+            return [position]
+
+    def apply_open(self, strategy, positions):
+        for i, position in enumerate(positions, 1):
             if position:
                 strategy.open_position(position)
                 self.pending_order_list.append(position)
-                open_msg = "Open {} ORDER #{} for {}/{} at {}".format(
-                    position.side,
+                part = ' {}/{}'.format(i, len(positions)) \
+                    if len(positions) > 1 else ''
+                open_msg = "Open{} {} ORDER #{} for {}/{} at {}".format(
+                    part, position.side,
                     position.order_id, position.instrument,
                     position.open_price,
                     position.open_time)
                 log.info(open_msg)
                 self.send_bot(open_msg)
-                return True
-        return False
+        return all(positions)
 
     def close_trade(self, strategy, price=None):
-        pos_to_remove = []
+        return self.apply_close(strategy, self.submit_close(strategy, price))
+
+    def submit_close(self, strategy, price=None):
+        '''
+        Cancel the pending orders and close the trades of a strategy with the
+        broker, returning the outcome for each position without updating
+        the portfolio, see apply_close().
+        '''
+        results = []
         for pos in strategy.positions:
             # Pending orders
             if pos in self.pending_order_list:
-                if self.broker.delete_pending_order(pos):
-                    self.pending_order_list.remove(pos)
+                results.append(
+                    (pos, 'pending', self.broker.delete_pending_order(pos)))
             # Active transaction
             elif pos in self.position_list:
                 # Hack to make backtests work, will get overwritten by real broker
                 if price:
                     pos.close_price = assert_decimal(price)
-                ret = self.broker.close_trade(pos)
+                results.append((pos, 'open', self.broker.close_trade(pos)))
+            else:
+                results.append((pos, None, None))
+                # raise ValueError("Critical error: Position was not "
+                #                 "registered with application.")
+        return results
+
+    def apply_close(self, strategy, results):
+        pos_to_remove = []
+        for pos, state, ret in results:
+            if state == 'pending':
+                if ret:
+                    self.pending_order_list.remove(pos)
+            elif state == 'open':
                 if ret:
                     pos.close()
                     close_msg = "Close TRADE #{} for {}/{} at {} [PROFIT: {}/Total: {}]".format(
@@ -171,8 +198,6 @@ class Portfolio(object):
                     pos_to_remove.append(pos)
             else:
                 pos_to_remove.append(pos)
-                # raise ValueError("Critical error: Position was not "
-                #                 "registered with application.")
         for pos in  pos_to_remove:
             strategy.close_position(pos)
         return True
@@ -185,14 +210,72 @@ class Portfolio(object):
 
         # TODO: Check if there is a buy/sell, then ignore
         # TODO: Run open()'s first, then update_transactions(), then close()'s
-        for ops in itertools.chain(*operations):
-            ops(self)
+        if self.mode == 'backtest' and settings.BACKTEST_SIMULATE_EXITS:
+            self.run_exits(strategies)
+        if self.mode == 'live' and settings.LIVE_ORDER_THREADS > 1:
+            self.run_concurrently(list(itertools.chain(*operations)))
+        else:
+            for ops in itertools.chain(*operations):
+                ops(self)
         self.update_transactions(strategies)
 
+    def _submit_group(self, group):
+        results = []
+        for ops in group:
+            try:
+                results.append(ops.submit(self))
+            except Exception as e:
+                log.exception("[!] Error when submitting {} for {}, "
+                              "skipping its next operations: {}".format(
+                                  type(ops).__name__,
+                                  ops.strategy.instrument, e))
+                break
+        return results
+
+    def run_concurrently(self, operations):
+        '''
+        Send the operations of the different instruments to the broker
+        concurrently, those of an instrument one after the other (closes
+        before opens), then apply their results to the portfolio in order.
+        '''
+        groups = OrderedDict()
+        for ops in operations:
+            groups.setdefault(str(ops.strategy.instrument), []).append(ops)
+        groups = [sorted(group, key=lambda ops: not isinstance(ops, Close))
+                  for group in groups.values()]
+        if self._pool is None:
+            self._pool = ThreadPool(processes=settings.LIVE_ORDER_THREADS)
+        for group, results in zip(groups,
+                                  self._pool.map(self._submit_group, groups)):
+            for ops, result in zip(group, results):
+                ops.apply(self, result)
+
+    def run_exits(self, strategies):
+        '''
+        Close the positions whose stop loss or take profit the backtest
+        broker found to be reached since the last tick.
+        '''
+        open_positions = [pos for pos in self.position_list if pos.is_open]
+        for pos, price, close_time in self.broker.check_exits(open_positions):
+            pos.close_price = price
+            self.broker.close_trade(pos)
+            pos.close_time = close_time
+            pos.close()
+            log.info("Exit TRADE #{} for {}/{} at {} [PROFIT: {}/Total: "
+                     "{}]".format(pos.transaction_id, pos.instrument,
+                                  pos.close_price, pos.close_time,
+                                  pos.profit_cash, self.get_overall_profit()))
+            self.write_to_csv(pos)
+            for strategy in strategies:
+                if pos in strategy.positions:
+                    strategy.close_position(pos)
+
     def update_transactions(self, strategies):
         # TODO Here we should check all orders and transactions
-        for pos in self.pending_order_list:
-            ret = self.broker.sync_transactions(pos)
+        statuses = self.broker.sync_pending(self.pending_order_list)
+        # Iterate over a copy, as confirmed orders are removed from the list
+        for pos in list(self.pending_order_list):
+            ret = statuses.get(pos.order_id)
             if ret == 'PENDING':
                 continue
             elif ret == 'CONFIRMED':
@@ -208,21 +291,30 @@ class Portfolio(object):
                             break
         return True
 
+    def trade_record(self, position):
+        return OrderedDict(
+            open_time=position.open_time,
+            close_time=position.close_time,
+            instrument=position.instrument,
+            side=position.side,
+            open_price=position.open_price,
+            close_price=position.close_price,
+            profit_cash=position.profit_cash,
+            profit_pips=position.profit_pips,
+            max_profit_pips=position.max_profit_pips,
+            max_loss_pips=position.max_loss_pips,
+        )
+
+    def get_trades(self):
+        return [self.trade_record(pos) for pos in self.position_list
+                if not pos.is_open]
+
     def write_to_csv(self, position):
+        if not self.write_csv:
+            return
         add_headings = not os.path.isfile(self.csv_out_file)
         with open(self.csv_out_file, 'at') as fh:
-            items = OrderedDict(
-                open_time=position.open_time,
-                close_time=position.close_time,
-                instrument=position.instrument,
-                side=position.side,
-                open_price=position.open_price,
-                close_price=position.close_price,
-                profit_cash=position.profit_cash,
-                profit_pips=position.profit_pips,
-                max_profit_pips=position.max_profit_pips,
-                max_loss_pips=position.max_loss_pips,
-            )
+            items = self.trade_record(position)
 
             writer = csv.writer(fh)
             if add_headings:
@@ -338,16 +430,38 @@ class Portfolio(object):
 
 
 class Position(object):
+    """
+    An order, and the trade it opens, on an instrument.
+
+    The open price and the best and worst prices reached while the position
+    is open are kept as integers in units of ``10**-PIP_DIGITS`` pips, which
+    makes the per-tick updates of set_profit_loss() plain integer
+    arithmetic; Decimal prices are only built when they are reported.
+    """
+    PIP_DIGITS = 7
+
+    __slots__ = (
+        'side', 'instrument', 'open_time', 'order_id', 'order_type',
+        'stop_loss', 'take_profit', 'home_currency', 'is_open', 'profit_pips',
+        'profit_cash', 'transaction_id', 'close_price', 'close_time',
+        'max_profit_pips', 'max_loss_pips', '_open_price', '_sign',
+        '_scale', '_open', '_profit', '_loss',
+    )
+
     def __init__(self, side, instrument, open_price, open_time,
-                 order_id, order_type, stop_loss=None, home_currency='CHF'):
+                 order_id, order_type, stop_loss=None, take_profit=None,
+                 home_currency='CHF'):
         self.side = side
         self.instrument = instrument
+        self._sign = 1 if side == 'buy' else -1
+        self._scale = 10 ** self.PIP_DIGITS / float(str(instrument.pip))
         self.open_price = assert_decimal(open_price)
         self.open_time = open_time
         self.order_id = order_id
         self.order_type = order_type
-        if stop_loss:
-            self.stop_loss = assert_decimal(stop_loss)
+        self.stop_loss = assert_decimal(stop_loss) if stop_loss else None
+        self.take_profit = assert_decimal(take_profit) if take_profit \
+            else None
         self.home_currency = home_currency
 
         self.is_open = True
@@ -357,34 +471,51 @@ class Position(object):
         self.close_price = None
         self.close_time = None
 
-        self.max_profit = open_price
-        self.max_loss = open_price
+        # TODO If required, add expiry_date
+
+    def _ticks(self, price):
+        return int(round(float(price) * self._scale))
+
+    def _price(self, ticks):
+        return Decimal(ticks) / Decimal(self._scale)
+
+    @property
+    def open_price(self):
+        return self._open_price
+
+    @open_price.setter
+    def open_price(self, price):
+        # Brokers may confirm the position at another price
+        self._open_price = price
+        self._open = self._ticks(price)
+        self._profit = self._loss = 0
+        self.max_profit_pips = self.max_loss_pips = 0.
+
+    @property
+    def max_profit(self):
+        return self._price(self._open + self._sign * self._profit)
 
-        # TODO If required, add order_type, stop_loss, expiry_date
+    @property
+    def max_loss(self):
+        return self._price(self._open - self._sign * self._loss)
 
     def close(self):
         self.is_open = False
 
     def set_profit_loss(self, price):
-        # Min = Max Drawdown for StopLoss
-        # Max = Max Profit
-        # Both are initialised with the opening price
-        if self.side == 'buy':
-            if self.max_profit < Decimal(str(price.highBid)):
-                self.max_profit = Decimal(str(price.highBid))
-            if self.max_loss > Decimal(str(price.lowAsk)):
-                self.max_loss = Decimal(str(price.lowAsk))
+        # Max Profit and Max Drawdown (for StopLoss) since the opening, in
+        # ticks in the favourable direction
+        if self._sign > 0:
+            best, worst = price.highBid, price.lowAsk
         else:
-            if self.max_profit > Decimal(str(price.lowBid)):
-                self.max_profit = Decimal(str(price.lowBid))
-            if self.max_loss < Decimal(str(price.highAsk)):
-                self.max_loss = Decimal(str(price.highAsk))
-        self.max_profit_pips = round(abs(
-            float(float(self.max_profit) - float(self.open_price)) / float(
-                str((self.instrument.pip)))), 1)
-        self.max_loss_pips = round(abs(
-            float(float(self.open_price) - float(self.max_loss)) / float(
-                str((self.instrument.pip)))), 1)
+            best, worst = price.lowBid, price.highAsk
+        self._profit = max(
+            self._profit, self._sign * (self._ticks(best) - self._open))
+        self._loss = max(
+            self._loss, self._sign * (self._open - self._ticks(worst)))
+        self.max_profit_pips = round(
+            self._profit / 10. ** self.PIP_DIGITS, 1)
+        self.max_loss_pips = round(self._loss / 10. ** self.PIP_DIGITS, 1)
 
     def __str__(self):
         return "{} at {} [{}]".format(self.instrument, self.open_price,
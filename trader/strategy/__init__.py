@@ -1,6 +1,13 @@
 # -*- coding: utf-8 -*-
 
 class StrategyBase(object):
+    # Set when the indicators have been precomputed over the whole backtest
+    # feeds, see OandaBacktestBroker.precompute_indicators()
+    vectorized = False
+    # Names of the settings read by the strategy, which can be swept over
+    # with the trader-sweep command
+    setting_names = ()
+
     def __init__(self, instrument):
         self.instrument = instrument
         self.positions = []
@@ -27,5 +34,12 @@ class StrategyBase(object):
     def start(self, broker, tick):
         self.broker = broker
 
+    def annotate_data(self, feed, timeframe):
+        '''
+        Add the indicator columns used by the strategy to the given feed. It
+        may be called with a window of candles or with the complete history.
+        '''
+        return feed
+
     def tick(self, tick):
         self.last_tick = tick.isoformat()
@@ -84,7 +84,7 @@ class NewStrategy(StrategyBase):
         if df.empty:
             return has_changes
         else:
-            newest_time = df.tail(1).time.values[0]
+            newest_time = df.index[-1]
             if newest_time > self.last_candles[tf]:
                 has_changes = True
                 self.last_candles[tf] = newest_time
@@ -120,24 +120,36 @@ class NewStrategy(StrategyBase):
             has_changes = False
 
             for tf in self.timeframes:
-                if self._tf_time_check(tick, tf):
-                    # Query buffer_size of candles
-                    start = tick - \
-                        ((self.buffer_size + 1) * self.timeframe_delta[tf]) + \
-                        self.time_delta
-                    df = self.broker.get_history(
-                        instrument=self.instrument,
-                        granularity=tf,
-                        includeFirst='false',
-                        start=start.isoformat(),
-                        end=tick.isoformat(),
-                        include_current=settings.GET_INCOMPLETE_CANDLES,
-                    )
-
-                    # Check if there is a lapse in trading data
+                if not self._tf_time_check(tick, tf):
+                    continue
+
+                if self.vectorized:
+                    # Indicators were computed once over the whole feed
+                    df = self.broker.get_indicator_history(
+                        self.instrument, tf, tick,
+                        include_current=settings.GET_INCOMPLETE_CANDLES)
                     if self._has_changes(df, tf):
                         has_changes = True
-                        self.feeds[tf] = self.annotate_data(df, tf)
+                        self.feeds[tf] = df
+                    continue
+
+                # Query buffer_size of candles
+                start = tick - \
+                    ((self.buffer_size + 1) * self.timeframe_delta[tf]) + \
+                    self.time_delta
+                df = self.broker.get_history(
+                    instrument=self.instrument,
+                    granularity=tf,
+                    includeFirst='false',
+                    start=start,
+                    end=tick,
+                    include_current=settings.GET_INCOMPLETE_CANDLES,
+                )
+
+                # Check if there is a lapse in trading data
+                if self._has_changes(df, tf):
+                    has_changes = True
+                    self.feeds[tf] = self.annotate_data(df, tf)
 
             if has_changes:
                 if self.is_open:
@@ -1,7 +1,14 @@
 # -*- coding: utf-8 -*-
 
+from collections import deque
+
 import numpy as np
 
+try:
+    from scipy.signal import lfilter
+except ImportError:
+    lfilter = None
+
 
 def moving_average(x, n, type='simple'):
     """
@@ -21,6 +28,31 @@ def moving_average(x, n, type='simple'):
     return a
 
 
+def exponential_smoothing(x, alpha, initial):
+    """
+    compute y[i] = (1 - alpha) * y[i - 1] + alpha * x[i] for all the values
+    of x, starting from y[-1] = initial
+    """
+    x = np.asarray(x, dtype=np.float64)
+    decay = 1. - alpha
+    if lfilter is not None:
+        return lfilter([alpha], [1., -decay], x, zi=[decay * initial])[0]
+
+    # y[i] = decay**(i + 1) * (initial + sum(alpha * x[j] / decay**(j + 1)))
+    # for j <= i, computed in blocks short enough for decay**-block to stay
+    # finite
+    block = max(1, int(300. / -np.log(decay))) if 0 < decay < 1 else len(x)
+    y = np.empty_like(x)
+    for first in range(0, len(x), block):
+        chunk = x[first:first + block]
+        powers = decay ** np.arange(1, len(chunk) + 1)
+        y[first:first + block] = powers * (
+            initial + np.cumsum(alpha * chunk / powers))
+        if len(chunk):
+            initial = y[first + len(chunk) - 1]
+    return y
+
+
 def relative_strength(prices, n=14):
     """
     compute the n period relative strength indicator
@@ -32,25 +64,16 @@ def relative_strength(prices, n=14):
     seed = deltas[:n + 1]
     up = seed[seed >= 0].sum() / n
     down = -seed[seed < 0].sum() / n
-    rs = up / down
     rsi = np.zeros_like(prices)
-    rsi[:n] = 100. - 100. / (1. + rs)
-
-    for i in range(n, len(prices)):
-        delta = deltas[i - 1]  # cause the diff is 1 shorter
-
-        if delta > 0:
-            upval = delta
-            downval = 0.
-        else:
-            upval = 0.
-            downval = -delta
-
-        up = (up * (n - 1) + upval) / n
-        down = (down * (n - 1) + downval) / n
 
-        rs = up / down
-        rsi[i] = 100. - 100. / (1. + rs)
+    # Wilder's smoothing of the gains and losses after the seed
+    deltas = deltas[n - 1:]
+    ups = exponential_smoothing(np.where(deltas > 0, deltas, 0.), 1. / n, up)
+    downs = exponential_smoothing(np.where(deltas > 0, 0., -deltas), 1. / n,
+                                  down)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rsi[:n] = 100. - 100. / (1. + up / down)
+        rsi[n:] = 100. - 100. / (1. + ups / downs)
 
     return rsi
 
@@ -64,10 +87,119 @@ def moving_average_convergence(x, nslow=26, nfast=12, nsign=9, simple=False):
     macd_dict = {}
     macd_dict['fast'] = moving_average(x, nfast, type='exponential')
     macd_dict['slow'] = moving_average(x, nslow, type='exponential')
-    macd_dict['macd'] = map(lambda f, s: round(f - s, 5), macd_dict['fast'],
-                            macd_dict['slow'])
+    macd_dict['macd'] = np.round(macd_dict['fast'] - macd_dict['slow'], 5)
     macd_dict['sign'] = moving_average(macd_dict['macd'], nsign)
     if not simple:
         return macd_dict
     else:
         return macd_dict['macd']
+
+
+class OnlineSMA(object):
+    """
+    n period simple moving average updated one value at a time, in constant
+    time per value. Same values as talib.SMA: NaN for the first n - 1
+    values.
+    """
+
+    def __init__(self, n):
+        self.n = n
+        self.window = deque()
+        self.total = 0.
+        self.value = np.nan
+
+    def update(self, x):
+        self.window.append(x)
+        self.total += x
+        if len(self.window) > self.n:
+            self.total -= self.window.popleft()
+        if len(self.window) == self.n:
+            self.value = self.total / self.n
+        return self.value
+
+
+class OnlineEMA(object):
+    """
+    n period exponential moving average updated one value at a time. Same
+    values as talib.EMA: seeded with the simple average of the first n
+    values, NaN before.
+    """
+
+    def __init__(self, n):
+        self.n = n
+        self.k = 2. / (n + 1)
+        self.seed = OnlineSMA(n)
+        self.value = np.nan
+
+    def update(self, x):
+        if self.seed is not None:
+            self.value = self.seed.update(x)
+            if not np.isnan(self.value):
+                self.seed = None
+        else:
+            self.value += self.k * (x - self.value)
+        return self.value
+
+
+class OnlineMACD(object):
+    """
+    MACD line, signal line and histogram updated one value at a time. Same
+    values as talib.MACD: the fast average starts on the value the slow one
+    is seeded on, and all the outputs are NaN until the signal average is
+    seeded.
+    """
+
+    def __init__(self, nfast=12, nslow=26, nsign=9):
+        self.skip = nslow - nfast
+        self.fast = OnlineEMA(nfast)
+        self.slow = OnlineEMA(nslow)
+        self.sign = OnlineEMA(nsign)
+        self.value = (np.nan, np.nan, np.nan)
+
+    def update(self, x):
+        slow = self.slow.update(x)
+        if self.skip:
+            self.skip -= 1
+            return self.value
+        fast = self.fast.update(x)
+        if np.isnan(slow):
+            return self.value
+        macd = fast - slow
+        sign = self.sign.update(macd)
+        if not np.isnan(sign):
+            self.value = (macd, sign, macd - sign)
+        return self.value
+
+
+class OnlineRSI(object):
+    """
+    n period relative strength index with Wilder's smoothing updated one
+    value at a time. Same values as talib.RSI: NaN for the first n values.
+    """
+
+    def __init__(self, n=14):
+        self.n = n
+        self.count = 0
+        self.last = None
+        self.gain = self.loss = 0.
+        self.value = np.nan
+
+    def update(self, x):
+        if self.last is None:
+            self.last = x
+            return self.value
+        delta, self.last = x - self.last, x
+        gain, loss = max(delta, 0.), max(-delta, 0.)
+        self.count += 1
+        if self.count <= self.n:
+            # Simple averages of the first n changes
+            self.gain += gain / self.n
+            self.loss += loss / self.n
+            if self.count < self.n:
+                return self.value
+        else:
+            self.gain = (self.gain * (self.n - 1) + gain) / self.n
+            self.loss = (self.loss * (self.n - 1) + loss) / self.n
+        total = self.gain + self.loss
+        self.value = 100. * self.gain / total if total else 0.
+        return self.value